@@ -0,0 +1,108 @@
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime
+from typing import Callable, Optional
+
+from telegram_bot import (
+    DATE_LINE_REGEX,
+    parse_date_from_text,
+    parse_date_token,
+    parse_dates_from_texts,
+    resolve_raw_text,
+)
+
+STRPTIME_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%d/%m/%Y", "%d/%m/%y", "%d-%m-%Y", "%d-%m-%y")
+TEXT_CONTEXTS = ("{}", "Data: {}", "x{}", "{}5", "1{}", "• {} ore 10", "{} e 01/02/03", "ordine del {}.", "-{}", "{}/")
+
+
+def strptime_token(date_token: str) -> Optional[str]:
+    for fmt in STRPTIME_FORMATS:
+        try:
+            return datetime.strptime(date_token, fmt).date().strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+
+def strptime_text(value: str) -> Optional[str]:
+    match = DATE_LINE_REGEX.search(value.strip())
+    return strptime_token(match.group(1)) if match else None
+
+
+def synthetic_corpus(count: int, distinct: int, seed: int) -> list[str]:
+    generator = random.Random(seed)
+    tokens = []
+    for _ in range(max(1, distinct)):
+        day, month, year = generator.randint(0, 32), generator.randint(0, 13), generator.randint(0, 99)
+        separators = generator.choice(("//", "--", "/-"))
+        tokens.append(
+            generator.choice(
+                (
+                    f"{day:02d}{separators[0]}{month:02d}{separators[1]}{year:02d}",
+                    f"{day:02d}{separators[0]}{month:02d}{separators[1]}20{year:02d}",
+                    f"20{year:02d}-{month:02d}-{day:02d}",
+                )
+            )
+        )
+    tokens.append("Via Roma 12")
+    return [generator.choice(TEXT_CONTEXTS).format(generator.choice(tokens)) for _ in range(count)]
+
+
+def orders_corpus(path: str) -> list[str]:
+    with open(path, "r", encoding="utf-8") as handle:
+        data = json.load(handle)
+    blobs = data.get("blobs", {})
+    return [
+        line
+        for order in data.get("orders", [])
+        for line in resolve_raw_text(order, blobs).splitlines()
+        if line.strip()
+    ]
+
+
+def time_parser(parser: Callable[[str], Optional[str]], lines: list[str], rounds: int) -> float:
+    return time_batch_parser(lambda values: [parser(value) for value in values], lines, rounds)
+
+
+def time_batch_parser(parser: Callable[[list[str]], list], lines: list[str], rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        parser(lines)
+    return (time.perf_counter() - started) / (rounds * len(lines)) * 1_000_000
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Confronta il parser delle date con il vecchio ciclo strptime.")
+    parser.add_argument("--orders", help="file JSON di uno shard da usare come corpus (sola lettura)")
+    parser.add_argument("--lines", type=int, default=5000, help="righe sintetiche se --orders non è indicato")
+    parser.add_argument("--distinct", type=int, default=500, help="date diverse nel corpus sintetico")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    lines = orders_corpus(args.orders) if args.orders else synthetic_corpus(args.lines, args.distinct, args.seed)
+    if not lines:
+        print("Corpus vuoto.", file=sys.stderr)
+        return 1
+    rounds = max(1, args.rounds)
+    parse_date_token.cache_clear()
+    cold = time_parser(parse_date_from_text, lines, 1)
+    timings = [
+        ("strptime", time_parser(strptime_text, lines, rounds)),
+        ("freddo", cold),
+        ("cache", time_parser(parse_date_from_text, lines, rounds)),
+        ("batch", time_batch_parser(parse_dates_from_texts, lines, rounds)),
+    ]
+    cache = parse_date_token.cache_info()
+    print(f"Corpus: {len(lines)} righe x {rounds} giri")
+    for name, micros in timings:
+        print(f"  {name:<9} {micros:8.3f} µs/riga  ({timings[0][1] / micros:.1f}x)")
+    print(f"  cache token: {cache.hits} hit, {cache.misses} miss, {cache.currsize}/{cache.maxsize}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,470 @@
+import argparse
+import asyncio
+import csv
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Optional
+from urllib.parse import parse_qs, unquote
+
+FAKE_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+
+PRODUCTS = ("Dry", "Wax", "Hash", "Oil", "Rosin", "Gummies")
+UNITS = ("g", "g", "pz", "ml")
+PAYMENTS = ("paypal", "bonifico", "contanti", "crypto")
+FIRST_NAMES = ("Mario", "Luigi", "Anna", "Giulia", "Marco", "Sara", "Paolo", "Elena")
+LAST_NAMES = ("Rossi", "Verdi", "Bianchi", "Neri", "Russo", "Ferrari", "Esposito")
+DEFAULT_MIX = "form=5,numbered=3,callback=2,commands=2,csv=0.2"
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    server: "FakeBotAPI"
+
+    def log_message(self, format: str, *args: object) -> None:
+        return
+
+    def _send_json(self, payload: object) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("Content-Type", "")
+        params: Dict[str, str] = {}
+        if content_type.startswith("application/json") and body:
+            params = {key: str(value) for key, value in json.loads(body).items()}
+        elif content_type.startswith("application/x-www-form-urlencoded"):
+            params = {key: values[-1] for key, values in parse_qs(body.decode("utf-8")).items()}
+        if self.path == "/feed":
+            events = json.loads(body or b"{}").get("events", [])
+            self.server.record_feed(events)
+            self._send_json({"ok": True, "received": len(events)})
+            return
+        method = self.path.rsplit("/", 1)[-1]
+        self._send_json({"ok": True, "result": self.server.respond(method, params)})
+
+    def do_GET(self) -> None:
+        file_path = unquote(self.path).split(f"/file/bot{FAKE_TOKEN}/", 1)[-1]
+        content = self.server.files.get(file_path)
+        if content is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), FakeBotAPIHandler)
+        self.files: Dict[str, bytes] = {}
+        self.calls: Dict[str, int] = {}
+        self.feed_events = 0
+        self.feed_batches = 0
+        self._message_ids = itertools.count(1_000_000)
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+    @property
+    def base_file_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/file/bot"
+
+    @property
+    def feed_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/feed"
+
+    def record_feed(self, events: list) -> None:
+        with self._lock:
+            self.feed_events += len(events)
+            self.feed_batches += 1
+
+    def add_file(self, file_id: str, content: bytes) -> None:
+        self.files[f"documents/{file_id}"] = content
+
+    def respond(self, method: str, params: Dict[str, str]) -> object:
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            message_id = next(self._message_ids)
+        if method == "getMe":
+            return BOT_USER
+        if method == "getFile":
+            file_id = params.get("file_id", "")
+            content = self.files.get(f"documents/{file_id}", b"")
+            return {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(content),
+                "file_path": f"documents/{file_id}",
+            }
+        if method in ("sendMessage", "sendDocument", "editMessageText"):
+            chat_id = params.get("chat_id", "1")
+            message = {
+                "message_id": int(params.get("message_id") or message_id),
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id) if chat_id.lstrip("-").isdigit() else 1, "type": "private"},
+                "from": BOT_USER,
+            }
+            if method == "sendDocument":
+                message["document"] = {"file_id": f"out{message_id}", "file_unique_id": f"out{message_id}"}
+            else:
+                message["text"] = params.get("text", "")
+            return message
+        return True
+
+    def start(self) -> "FakeBotAPI":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class UpdateFactory:
+    def __init__(self, api: FakeBotAPI, seed: int) -> None:
+        self.api = api
+        self.random = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._user_ids = itertools.count(1000)
+        self.max_order_id = 1
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Operatore", "username": f"op{user_id}"}
+
+    def _message(self, user_id: int, **fields: object) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id),
+                **fields,
+            },
+        }
+
+    def text(self, user_id: int, text: str) -> dict:
+        return self._message(user_id, text=text)
+
+    def command(self, user_id: int, command: str, *args: str) -> dict:
+        text = " ".join([f"/{command}", *args])
+        entity = {"type": "bot_command", "offset": 0, "length": len(command) + 1}
+        return self._message(user_id, text=text, entities=[entity])
+
+    def callback(self, user_id: int, data: str) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": BOT_USER,
+            "text": "...",
+        }
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": message,
+            },
+        }
+
+    def document(self, user_id: int, file_name: str, content: bytes) -> dict:
+        file_id = f"in{next(self._update_ids)}"
+        self.api.add_file(file_id, content)
+        document = {"file_id": file_id, "file_unique_id": file_id, "file_name": file_name, "file_size": len(content)}
+        return self._message(user_id, document=document)
+
+    def _order_fields(self) -> Dict[str, str]:
+        first_name = self.random.choice(FIRST_NAMES)
+        last_name = self.random.choice(LAST_NAMES)
+        return {
+            "username_telegram": f"@{first_name.lower()}{self.random.randint(1, 500)}",
+            "prodotti": self.random.choice(PRODUCTS),
+            "quantita": f"{self.random.randint(1, 20)}{self.random.choice(UNITS)}",
+            "metodo_pagamento": self.random.choice(PAYMENTS),
+            "nome_cognome": f"{first_name} {last_name}",
+            "contatto": f"+39 3{self.random.randint(10, 99)} {self.random.randint(1000000, 9999999)}",
+            "indirizzo": f"Via Roma {self.random.randint(1, 200)}, Milano",
+            "put_date": f"{self.random.randint(1, 28):02d}/{self.random.randint(1, 12):02d}/2026",
+        }
+
+    def form_scenario(self) -> list[dict]:
+        fields = self._order_fields()
+        text = "\n".join(
+            [
+                f"Username Telegram: {fields['username_telegram']}",
+                "Informazioni ordine",
+                f"Prodotto/i: {fields['prodotti']}",
+                f"Quantità: {fields['quantita']}",
+                f"Metodo di pagamento scelto: {fields['metodo_pagamento']}",
+                "Informazioni spedizione",
+                f"Nome e Cognome: {fields['nome_cognome']}",
+                f"Num di Tel / Email: {fields['contatto']}",
+                f"Indirizzo o punto di ritiro: {fields['indirizzo']}",
+                fields["put_date"],
+            ]
+        )
+        self.max_order_id += 1
+        return [self.text(next(self._user_ids), text)]
+
+    def numbered_scenario(self) -> list[dict]:
+        lines = []
+        count = self.random.randint(2, 10)
+        for index in range(1, count + 1):
+            fields = self._order_fields()
+            lines.append(f"{index}. {fields['username_telegram']} | {fields['prodotti']} ({fields['quantita']})")
+            lines.append(
+                f"• {fields['indirizzo']} | {fields['nome_cognome']} | {fields['contatto']} | {fields['put_date']}"
+            )
+        self.max_order_id += count
+        return [self.text(next(self._user_ids), "\n".join(lines))]
+
+    def callback_scenario(self) -> list[dict]:
+        user_id = next(self._user_ids)
+        order_id = str(self.random.randint(1, self.max_order_id))
+        if self.random.random() < 0.5:
+            other_id = str(self.random.randint(1, self.max_order_id))
+            return [self.callback(user_id, "ready_prompt"), self.text(user_id, f"{order_id},{other_id}")]
+        return [
+            self.callback(user_id, f"edit_prompt:{order_id}"),
+            self.callback(user_id, f"edit_field:{order_id}:note"),
+            self.text(user_id, f"Consegna entro le {self.random.randint(9, 19)}"),
+        ]
+
+    def commands_scenario(self) -> list[dict]:
+        user_id = next(self._user_ids)
+        choice = self.random.choice(("orders", "orders_pending", "totals", "order", "export", "search"))
+        if choice == "orders":
+            return [self.command(user_id, "orders")]
+        if choice == "orders_pending":
+            return [self.command(user_id, "orders", "--pending")]
+        if choice == "order":
+            return [self.command(user_id, "order", str(self.random.randint(1, self.max_order_id)))]
+        if choice == "search":
+            return [self.command(user_id, "search", self.random.choice(PRODUCTS).lower())]
+        return [self.command(user_id, choice)]
+
+    def csv_scenario(self) -> list[dict]:
+        user_id = next(self._user_ids)
+        headers = ["id", "created_at", "ready", "sender", "username_telegram", "prodotti", "quantita",
+                   "metodo_pagamento", "nome_cognome", "contatto", "indirizzo", "note", "raw_text"]
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=headers)
+        writer.writeheader()
+        rows = self.random.randint(50, 300)
+        for order_id in range(1, rows + 1):
+            fields = self._order_fields()
+            fields.pop("put_date")
+            writer.writerow(
+                {
+                    "id": order_id,
+                    "created_at": "2026-02-04 10:00 UTC",
+                    "ready": self.random.choice(("yes", "no")),
+                    "sender": f"op{user_id}",
+                    "note": "",
+                    "raw_text": " | ".join(fields.values()),
+                    **fields,
+                }
+            )
+        self.max_order_id = rows
+        content = buffer.getvalue().encode("utf-8")
+        return [self.command(user_id, "import"), self.document(user_id, "orders_export.csv", content)]
+
+    def synthetic(self, count: int, mix: Dict[str, float]) -> list[list[dict]]:
+        builders = {
+            "form": self.form_scenario,
+            "numbered": self.numbered_scenario,
+            "callback": self.callback_scenario,
+            "commands": self.commands_scenario,
+            "csv": self.csv_scenario,
+        }
+        kinds = [kind for kind in mix if mix[kind] > 0]
+        weights = [mix[kind] for kind in kinds]
+        scenarios: list[list[dict]] = []
+        total = 0
+        while total < count:
+            scenario = builders[self.random.choices(kinds, weights)[0]]()
+            scenarios.append(scenario)
+            total += len(scenario)
+        return scenarios
+
+
+def load_recorded_scenarios(path: str) -> list[list[dict]]:
+    by_user: Dict[object, list[dict]] = {}
+    with open(path, "r", encoding="utf-8") as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            payload = json.loads(line)
+            source = payload.get("message") or payload.get("callback_query") or {}
+            user_id = (source.get("from") or {}).get("id")
+            by_user.setdefault(user_id, []).append(payload)
+    return list(by_user.values())
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix: Dict[str, float] = {}
+    for part in value.split(","):
+        if not part.strip():
+            continue
+        kind, _, weight = part.partition("=")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+class Pacer:
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.next_at: Optional[float] = None
+
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        if self.next_at is None or self.next_at < now:
+            self.next_at = now
+        delay = self.next_at - now
+        self.next_at += self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def run_load(args: argparse.Namespace, api: FakeBotAPI) -> dict:
+    import telegram_bot
+    from telegram import Update
+    from telegram.ext import Application
+
+    factory = UpdateFactory(api, args.seed)
+    if args.replay:
+        scenarios = load_recorded_scenarios(args.replay)
+    else:
+        scenarios = factory.synthetic(args.updates, parse_mix(args.mix))
+
+    builder = Application.builder().token(FAKE_TOKEN).base_url(api.base_url).base_file_url(api.base_file_url)
+    application = telegram_bot.build_application(builder)
+    errors: list[str] = []
+
+    async def count_error(update: object, context: object) -> None:
+        errors.append(repr(getattr(context, "error", None)))
+
+    application.add_error_handler(count_error)
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(max(1, args.concurrency))
+    pacer = Pacer(args.rate)
+
+    async def run_scenario(payloads: Iterable[dict]) -> None:
+        async with semaphore:
+            for payload in payloads:
+                await pacer.wait()
+                update = Update.de_json(payload, application.bot)
+                started = time.perf_counter()
+                await application.process_update(update)
+                latencies.append(time.perf_counter() - started)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    bytes_before = telegram_bot.ORDER_SHARDS.bytes_written
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(run_scenario(scenario) for scenario in scenarios))
+    finally:
+        elapsed = time.perf_counter() - started
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+        api.shutdown()
+    return {
+        "updates": len(latencies),
+        "scenarios": len(scenarios),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+            "max": round(max(latencies, default=0.0) * 1000, 2),
+        },
+        "storage_bytes_written": telegram_bot.ORDER_SHARDS.bytes_written - bytes_before,
+        "render_cache_hit_rate": round(telegram_bot.RENDER_CACHE.hit_rate, 3),
+        "feed_events": api.feed_events,
+        "feed_batches": api.feed_batches,
+        "errors": len(errors),
+        "api_calls": dict(sorted(api.calls.items())),
+    }
+
+
+def format_report(report: dict) -> str:
+    latency = report["latency_ms"]
+    lines = [
+        f"updates: {report['updates']} in {report['scenarios']} scenari, {report['elapsed_s']}s",
+        f"throughput: {report['throughput_ups']} update/s",
+        f"latency ms: p50 {latency['p50']} | p95 {latency['p95']} | p99 {latency['p99']} | max {latency['max']}",
+        f"storage bytes written: {report['storage_bytes_written']}",
+        f"render cache hit rate: {report['render_cache_hit_rate']:.1%}",
+        f"change feed: {report['feed_events']} eventi in {report['feed_batches']} batch",
+        f"errors: {report['errors']}",
+        "api calls: " + ", ".join(f"{method}={count}" for method, count in report["api_calls"].items()),
+    ]
+    return "\n".join(lines)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Replay di update Telegram contro un Bot API finto locale.")
+    parser.add_argument("--replay", help="file JSONL di update registrati (RECORD_UPDATES_PATH)")
+    parser.add_argument("--updates", type=int, default=500, help="numero di update sintetici")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="pesi degli scenari sintetici")
+    parser.add_argument("--rate", type=float, default=0.0, help="update al secondo (0 = senza limite)")
+    parser.add_argument("--concurrency", type=int, default=8, help="scenari eseguiti in parallelo")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", help="directory dati (default: temporanea)")
+    parser.add_argument("--feed", action="store_true", help="invia il change feed al Bot API finto")
+    parser.add_argument("--json", action="store_true", help="stampa il report in JSON")
+    args = parser.parse_args(argv)
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="orders-load-")
+    os.environ["BOT_TOKEN"] = FAKE_TOKEN
+    os.environ["ORDERS_DATA_DIR"] = data_dir
+    os.environ["ORDERS_DATA_PATH"] = os.path.join(data_dir, "orders.json")
+    os.environ.pop("RECORD_UPDATES_PATH", None)
+    api = FakeBotAPI().start()
+    if args.feed:
+        os.environ["CHANGE_FEED_URL"] = api.feed_url
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("telegram_bot").setLevel(logging.WARNING)
+
+    report = asyncio.run(run_load(args, api))
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,48 @@
+import argparse
+import asyncio
+import base64
+import bisect
+import cProfile
 import csv
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
 import json
 import logging
 import os
+import pickle
+import pstats
 import re
+import shutil
+import sys
 import tempfile
-from datetime import date, datetime
-from typing import Dict, Iterable, Optional, Tuple
-
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from datetime import date, datetime, time as dtime, timedelta
+from typing import Callable, Dict, Iterable, Iterator, NamedTuple, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import requests
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
     Application,
+    ApplicationBuilder,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
@@ -21,11 +50,46 @@ logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise ValueError("❌ BOT_TOKEN non trovato!")
 
 DEFAULT_DATA_DIR = os.getenv("ORDERS_DATA_DIR", "data")
 DATA_PATH = os.getenv("ORDERS_DATA_PATH", os.path.join(DEFAULT_DATA_DIR, "orders.json"))
+SHARDS_DIR = os.getenv("ORDERS_SHARDS_DIR", os.path.join(DEFAULT_DATA_DIR, "shards"))
+ORDERS_SHARD_BY = os.getenv("ORDERS_SHARD_BY", "none").strip().lower()
+ORDERS_TEAMS = {
+    int(chat_id): team.strip()
+    for team, chat_ids in (
+        entry.split(":", 1) for entry in os.getenv("ORDERS_TEAMS", "").split(";") if ":" in entry
+    )
+    for chat_id in re.findall(r"-?\d+", chat_ids)
+}
+CATALOG_PATH = os.getenv("PRODUCT_CATALOG_PATH", os.path.join(DEFAULT_DATA_DIR, "catalog.json"))
+BACKUP_DIR = os.getenv("BACKUP_DIR", os.path.join(DEFAULT_DATA_DIR, "backups"))
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", "3600"))
+BACKUP_FULL_EVERY = int(os.getenv("BACKUP_FULL_EVERY", "24"))
+BACKUP_KEEP_HOURLY = int(os.getenv("BACKUP_KEEP_HOURLY", "24"))
+BACKUP_KEEP_DAILY = int(os.getenv("BACKUP_KEEP_DAILY", "7"))
+BACKUP_KEEP_WEEKLY = int(os.getenv("BACKUP_KEEP_WEEKLY", "4"))
+DIGEST_CONFIG_PATH = os.getenv("DIGEST_CONFIG_PATH", os.path.join(DEFAULT_DATA_DIR, "digests.json"))
+DIGEST_TIMEZONE = os.getenv("DIGEST_TIMEZONE", "Europe/Rome")
+CHANGE_FEED_PATH = os.getenv("CHANGE_FEED_PATH")
+CHANGE_FEED_URL = os.getenv("CHANGE_FEED_URL")
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "4096"))
+BINARY_SNAPSHOTS = os.getenv("ORDERS_BINARY_SNAPSHOTS", "1") != "0"
+BINARY_SNAPSHOT_FORMAT = 4
+DATE_TOKEN_CACHE_SIZE = int(os.getenv("DATE_TOKEN_CACHE_SIZE", "1024"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "200"))
+INGEST_MAX_DRAFTS = int(os.getenv("INGEST_MAX_DRAFTS", "20"))
+INGEST_MAX_BLOCK_CHARS = 20000
+INGEST_PROGRESS_INTERVAL = 2.0
+PARSER_METRICS_ENABLED = os.getenv("PARSER_METRICS", "0") == "1"
+PARSER_SLOW_BLOCKS = int(os.getenv("PARSER_SLOW_BLOCKS", "10"))
+RAW_TEXT_INLINE_LIMIT = int(os.getenv("RAW_TEXT_INLINE_LIMIT", "160"))
+MAX_LOADED_SHARDS = int(os.getenv("ORDERS_MAX_LOADED_SHARDS", "16"))
+DEFAULT_SHARD = "default"
+RECORD_UPDATES_PATH = os.getenv("RECORD_UPDATES_PATH")
+ADMIN_USER_IDS = {int(value) for value in re.findall(r"\d+", os.getenv("ADMIN_USER_IDS", ""))}
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "0"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
 
 ORDER_FIELDS = {
     "username_telegram": "Username Telegram",
@@ -38,6 +102,23 @@ ORDER_FIELDS = {
     "note": "Eventuali note o richieste speciali",
 }
 
+CUSTOMER_PAGE_SIZE = 10
+
+RAW_TEXT_ZDICT = (
+    "Contanti\nPayPal\nBonifico\nSatispay\nRitiro a mano\nSpedizione\nNessuna\n"
+    "Eventuali note o richieste speciali: \n"
+    "Indirizzo o punto di ritiro: Via \n"
+    "Num di Tel / Email: +39 \n"
+    "Nome e Cognome: \n"
+    "Metodo di pagamento scelto: \n"
+    "Quantità: \n"
+    "Prodotto/i: \n"
+    "Username Telegram: @"
+).encode("utf-8")
+
+EXPORT_HEADERS = ["id", "created_at", "ready", "sender", *ORDER_FIELDS.keys(), "raw_text"]
+DELTA_EXPORT_HEADERS = [*EXPORT_HEADERS, "seq", "deleted"]
+
 REQUIRED_FIELDS = (
     "username_telegram",
     "prodotti",
@@ -49,7 +130,6 @@ REQUIRED_FIELDS = (
 )
 
 DATE_LINE_REGEX = re.compile(r"\b(\d{4}-\d{2}-\d{2}|\d{2}[/-]\d{2}[/-]\d{2,4})\b")
-DATE_LINE_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%d/%m/%Y", "%d/%m/%y", "%d-%m-%Y", "%d-%m-%y")
 
 LABEL_MAP = {
     "username": "username_telegram",
@@ -79,70 +159,1216 @@ def normalize_label(label: str) -> str:
     return cleaned
 
 
-def load_orders() -> Dict[str, dict]:
-    if not os.path.exists(DATA_PATH):
-        return {"next_id": 1, "orders": []}
-    with open(DATA_PATH, "r", encoding="utf-8") as handle:
-        return json.load(handle)
+def normalize_username(value: str) -> str:
+    return value.strip().lstrip("@").lower()
+
+
+def order_fingerprint(order: Dict[str, str]) -> str:
+    username = normalize_username(order.get("username_telegram") or order.get("sender") or "")
+    products = normalize_product_key(order.get("prodotti") or "")
+    quantities = " ".join(parse_quantity_list(order.get("quantita") or "")).lower()
+    order_day = order.get("put_date") or (order.get("created_at") or "")[:10]
+    return "|".join((username, products, quantities, order_day))
+
+
+def normalize_contact(value: str) -> str:
+    cleaned = value.strip().lower()
+    if "@" not in cleaned:
+        digits = re.sub(r"\D", "", cleaned)
+        if len(digits) >= 6:
+            return digits
+    return re.sub(r"\s+", "", cleaned)
+
+
+def order_customer_keys(order: Dict[str, str]) -> list[str]:
+    keys = []
+    username = normalize_username(order.get("username_telegram") or "")
+    if username:
+        keys.append(f"u:{username}")
+    contact = normalize_contact(order.get("contatto") or "")
+    if contact:
+        keys.append(f"c:{contact}")
+    return keys
+
+
+def order_date_key(order: Dict[str, str]) -> str:
+    return (order.get("created_at") or order.get("put_date") or "")[:16]
+
+
+def raw_text_hash(value: str) -> str:
+    normalized = re.sub(r"\s+", " ", value.strip().lower())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def compress_raw_text(value: str) -> Dict[str, str]:
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, RAW_TEXT_ZDICT)
+    packed = base64.b64encode(compressor.compress(value.encode("utf-8")) + compressor.flush()).decode("ascii")
+    if len(packed) >= len(value.encode("utf-8")):
+        return {"t": value}
+    return {"z": packed}
+
+
+def decompress_raw_text(blob: Dict[str, object]) -> str:
+    if "t" in blob:
+        return blob["t"]
+    decompressor = zlib.decompressobj(-15, zdict=RAW_TEXT_ZDICT)
+    data = decompressor.decompress(base64.b64decode(blob["z"])) + decompressor.flush()
+    return data.decode("utf-8")
+
+
+def resolve_raw_text(order: Dict[str, object], blobs: Dict[str, dict]) -> str:
+    if "raw_text" in order:
+        return order["raw_text"] or ""
+    blob = blobs.get(order.get("raw_ref"))
+    return decompress_raw_text(blob) if blob else ""
+
+
+def resolve_raw_text_key(order: Dict[str, object], blobs: Dict[str, dict]) -> Optional[str]:
+    if order.get("raw_text"):
+        return raw_text_hash(order["raw_text"])
+    blob = blobs.get(order.get("raw_ref"))
+    return blob["h"] if blob else None
+
+
+class JsonlFeedSink:
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def send(self, events: list[dict]) -> None:
+        feed_dir = os.path.dirname(self.path)
+        if feed_dir:
+            os.makedirs(feed_dir, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as handle:
+            for event in events:
+                handle.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+class HttpFeedSink:
+    def __init__(self, url: str, timeout: float = 10.0) -> None:
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def send(self, events: list[dict]) -> None:
+        response = self.session.post(self.url, json={"events": events}, timeout=self.timeout)
+        response.raise_for_status()
+
+
+class ChangeFeed:
+    def __init__(
+        self,
+        sinks: list,
+        max_queue: int,
+        batch_size: int,
+        flush_interval: float,
+        max_retries: int,
+    ) -> None:
+        self.sinks = sinks
+        self.max_queue = max_queue
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_retries = max(1, max_retries)
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.synchronous = False
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.sinks)
+
+    def publish(self, events: list[dict]) -> None:
+        if self.synchronous and self.enabled:
+            self.deliver_now(events)
+            return
+        if self.queue is None:
+            return
+        for event in events:
+            try:
+                self.queue.put_nowait(event)
+                self.published += 1
+            except asyncio.QueueFull:
+                self.dropped += 1
+                if self.dropped == 1 or self.dropped % 100 == 0:
+                    logger.warning("Coda change feed piena: %s eventi scartati", self.dropped)
+
+    def deliver_now(self, events: list[dict]) -> None:
+        for start in range(0, len(events), self.batch_size):
+            batch = events[start : start + self.batch_size]
+            self.published += len(batch)
+            delivered = True
+            for sink in self.sinks:
+                for attempt in range(self.max_retries):
+                    try:
+                        sink.send(batch)
+                        break
+                    except Exception as error:
+                        if attempt + 1 == self.max_retries:
+                            delivered = False
+                            logger.error("Consegna change feed fallita (%s): %s", type(sink).__name__, error)
+                            break
+                        time.sleep(min(30.0, 0.5 * 2**attempt))
+            if delivered:
+                self.delivered += len(batch)
+            else:
+                self.dropped += len(batch)
+
+    async def start(self) -> None:
+        if not self.enabled or self.task is not None:
+            return
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.task = asyncio.create_task(self._run(self.queue))
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        if self.task is None:
+            return
+        queue, self.queue = self.queue, None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            await asyncio.wait_for(queue.put(None), timeout)
+            await asyncio.wait_for(self.task, max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            self.task.cancel()
+            logger.warning("Change feed chiuso con %s eventi non consegnati", queue.qsize())
+        self.task = None
+
+    async def _run(self, queue: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            event = await queue.get()
+            if event is None:
+                break
+            batch = [event]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event)
+            await self._deliver(batch)
+
+    async def _deliver(self, batch: list[dict]) -> None:
+        delivered = True
+        for sink in self.sinks:
+            for attempt in range(self.max_retries):
+                try:
+                    await asyncio.to_thread(sink.send, batch)
+                    break
+                except Exception as error:
+                    if attempt + 1 == self.max_retries:
+                        delivered = False
+                        logger.error("Consegna change feed fallita (%s): %s", type(sink).__name__, error)
+                        break
+                    await asyncio.sleep(min(30.0, 0.5 * 2**attempt))
+        if delivered:
+            self.delivered += len(batch)
+        else:
+            self.dropped += len(batch)
+
+
+def build_change_feed() -> ChangeFeed:
+    sinks: list = []
+    if CHANGE_FEED_PATH:
+        sinks.append(JsonlFeedSink(CHANGE_FEED_PATH))
+    if CHANGE_FEED_URL:
+        sinks.append(HttpFeedSink(CHANGE_FEED_URL))
+    return ChangeFeed(
+        sinks,
+        max_queue=int(os.getenv("CHANGE_FEED_QUEUE_SIZE", "1000")),
+        batch_size=int(os.getenv("CHANGE_FEED_BATCH_SIZE", "100")),
+        flush_interval=float(os.getenv("CHANGE_FEED_FLUSH_INTERVAL", "1.0")),
+        max_retries=int(os.getenv("CHANGE_FEED_MAX_RETRIES", "5")),
+    )
+
+
+CHANGE_FEED = build_change_feed()
+
+
+class RenderCache:
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max(0, max_size)
+        self.entries: "OrderedDict[Tuple[str, object, str], Tuple[int, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def render(self, namespace: str, kind: str, order: Dict[str, str], renderer) -> str:
+        seq = order.get("seq")
+        if seq is None or not self.max_size:
+            return renderer(order)
+        key = (namespace, order["id"], kind)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == seq:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+        self.misses += 1
+        text = renderer(order)
+        self.entries[key] = (seq, text)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return text
+
+    def invalidate(self, namespace: str, order_id: object) -> None:
+        for kind in ("card", "line"):
+            self.entries.pop((namespace, order_id, kind), None)
+
+    def invalidate_namespace(self, namespace: str) -> None:
+        for key in [key for key in self.entries if key[0] == namespace]:
+            del self.entries[key]
+
+
+RENDER_CACHE = RenderCache(RENDER_CACHE_SIZE)
+
+
+def mask_text(value: str) -> str:
+    return re.sub(r"\d", "9", re.sub(r"[^\W\d_]", "x", value))
+
+
+def redact_block(text: str, max_chars: int = 400) -> str:
+    lines = []
+    for line in text[:max_chars].splitlines():
+        label, separator, value = line.partition(":")
+        if separator and normalize_label(label).strip() in LABEL_MAP:
+            lines.append(f"{label}{separator}{mask_text(value)}")
+        else:
+            lines.append(mask_text(line))
+    return "\n".join(lines) + ("…" if len(text) > max_chars else "")
+
+
+class ParserMetrics:
+    def __init__(self, enabled: bool, slow_capacity: int) -> None:
+        self.enabled = enabled
+        self.slow_capacity = max(0, slow_capacity)
+        self.reset()
+
+    def reset(self) -> None:
+        self.counters: Counter = Counter()
+        self.blocks: Counter = Counter()
+        self.seconds: Dict[str, float] = {}
+        self.max_seconds: Dict[str, float] = {}
+        self.slowest: list[Tuple[float, int, str, str]] = []
+        self._sequence = 0
+
+    def record_block(self, kind: str, text: str, elapsed: float) -> None:
+        self.blocks[kind] += 1
+        self.seconds[kind] = self.seconds.get(kind, 0.0) + elapsed
+        self.max_seconds[kind] = max(self.max_seconds.get(kind, 0.0), elapsed)
+        if not self.slow_capacity:
+            return
+        if len(self.slowest) < self.slow_capacity:
+            self._sequence += 1
+            heapq.heappush(self.slowest, (elapsed, self._sequence, kind, redact_block(text)))
+        elif elapsed > self.slowest[0][0]:
+            self._sequence += 1
+            heapq.heapreplace(self.slowest, (elapsed, self._sequence, kind, redact_block(text)))
+
+    def summary(self) -> str:
+        if not self.enabled:
+            return "Parser: metriche disattivate"
+        parts = [
+            f"{kind} {count} blocchi, media {self.seconds[kind] / count * 1000:.2f}ms, "
+            f"max {self.max_seconds[kind] * 1000:.2f}ms"
+            for kind, count in sorted(self.blocks.items())
+        ]
+        return "Parser: " + ("; ".join(parts) if parts else "nessun blocco")
+
+    def report_lines(self, top: int = 25) -> list[str]:
+        lines = [self.summary()]
+        if self.counters:
+            lines.append("")
+            lines.append("Rami più usati:")
+            lines.extend(f"• {name}: {count}" for name, count in self.counters.most_common(top))
+        if self.slowest:
+            lines.append("")
+            lines.append(f"Blocchi più lenti ({len(self.slowest)}):")
+            for elapsed, _, kind, text in sorted(self.slowest, reverse=True):
+                lines.append(f"— {kind} {elapsed * 1000:.2f}ms\n{text}")
+        return lines
+
+
+PARSER_METRICS = ParserMetrics(PARSER_METRICS_ENABLED, PARSER_SLOW_BLOCKS)
+
+
+def instrumented_parser(kind: str) -> Callable:
+    def decorate(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(text: str) -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+            if not PARSER_METRICS.enabled:
+                return function(text)
+            started = time.perf_counter()
+            result = function(text)
+            PARSER_METRICS.record_block(kind, text, time.perf_counter() - started)
+            return result
+
+        return wrapper
+
+    return decorate
+
+
+class OrderSnapshot(NamedTuple):
+    version: int
+    orders: Tuple[dict, ...]
+    blobs: Dict[str, dict]
+
+    def raw_text(self, order: Dict[str, object]) -> str:
+        return resolve_raw_text(order, self.blobs)
+
+    def raw_text_key(self, order: Dict[str, object]) -> Optional[str]:
+        return resolve_raw_text_key(order, self.blobs)
+
+    def export_order(self, order: dict) -> dict:
+        exported = {key: value for key, value in order.items() if key != "raw_ref"}
+        exported["raw_text"] = self.raw_text(order)
+        return exported
+
+
+class StoreLock:
+    def __init__(self, store: "OrderStore") -> None:
+        self.store = store
+        self.mutex = asyncio.Lock()
+
+    def locked(self) -> bool:
+        return self.mutex.locked()
+
+    async def __aenter__(self) -> "StoreLock":
+        await self.mutex.acquire()
+        try:
+            while not self.store.acquire_file_lock(blocking=False):
+                await asyncio.sleep(0.05)
+            self.store.load()
+        except BaseException:
+            self.store.release_file_lock()
+            self.mutex.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        self.store.release_file_lock()
+        self.mutex.release()
+
+
+class OrderStore:
+    def __init__(self, path: str, shard_key: str = DEFAULT_SHARD) -> None:
+        self.path = path
+        self.shard_key = shard_key
+        self.pending_events: list[dict] = []
+        self.data: Dict[str, object] = {"next_id": 1, "orders": []}
+        self.version = 0
+        self.by_id: Dict[str, dict] = {}
+        self.positions: Dict[str, int] = {}
+        self.change_log: list[Tuple[int, int]] = []
+        self.fingerprints: Dict[str, list[int]] = {}
+        self.raw_hashes: Dict[str, list[int]] = {}
+        self.customers: Dict[str, dict] = {}
+        self.order_ids: list[int] = []
+        self.pending_by_day: Dict[str, int] = {}
+        self.pending_products: Dict[Tuple[str, str], dict] = {}
+        self.pending_ids: set = set()
+        self.created_index: list[Tuple[str, int]] = []
+        self.undated_ids: set = set()
+        self.words: Dict[str, set] = {}
+        self.bytes_written = 0
+        self.lock = StoreLock(self)
+        self._lock_handle = None
+        self._stamp: object = False
+        self._binary_stamp: object = False
+        self._snapshot: Optional[OrderSnapshot] = None
+        self._blobs_shared = False
+
+    def _file_stamp(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    @property
+    def orders(self) -> list[dict]:
+        return self.data.setdefault("orders", [])
+
+    @property
+    def binary_path(self) -> str:
+        return f"{self.path}.snap"
+
+    def acquire_file_lock(self, blocking: bool = True) -> bool:
+        if fcntl is None:
+            return True
+        if self._lock_handle is None:
+            data_dir = os.path.dirname(self.path)
+            if data_dir:
+                os.makedirs(data_dir, exist_ok=True)
+            self._lock_handle = open(f"{self.path}.lock", "a", encoding="utf-8")
+        try:
+            fcntl.flock(self._lock_handle, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def release_file_lock(self) -> None:
+        if fcntl is not None and self._lock_handle is not None:
+            fcntl.flock(self._lock_handle, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        if self._lock_handle is not None:
+            self._lock_handle.close()
+            self._lock_handle = None
+
+    @contextmanager
+    def locked(self) -> Iterator["OrderStore"]:
+        self.acquire_file_lock()
+        try:
+            self.load()
+            yield self
+        finally:
+            self.release_file_lock()
+
+    def load(self) -> Dict[str, object]:
+        stamp = self._file_stamp()
+        if stamp == self._stamp:
+            return self.data
+        started = time.perf_counter()
+        source = "json"
+        if stamp is None:
+            self.data = {"next_id": 1, "orders": []}
+            self.rebuild_indexes()
+        elif self._load_binary_snapshot(stamp):
+            source = "snapshot"
+        else:
+            with open(self.path, "r", encoding="utf-8") as handle:
+                self.data = json.load(handle)
+            self.rebuild_indexes()
+        self._stamp = stamp
+        if stamp is not None:
+            logger.info(
+                "Shard %s caricato da %s in %.3fs (%s ordini)",
+                self.shard_key,
+                source,
+                time.perf_counter() - started,
+                len(self.orders),
+            )
+        return self.data
+
+    def _load_binary_snapshot(self, stamp: Tuple[int, int, int]) -> bool:
+        if not BINARY_SNAPSHOTS:
+            return False
+        try:
+            with open(self.binary_path, "rb") as handle:
+                header = pickle.load(handle)
+                if (
+                    not isinstance(header, dict)
+                    or header.get("format") != BINARY_SNAPSHOT_FORMAT
+                    or header.get("stamp") != stamp
+                ):
+                    return False
+                payload = pickle.load(handle)
+        except FileNotFoundError:
+            return False
+        except (OSError, EOFError, AttributeError, ValueError, pickle.UnpicklingError):
+            logger.warning("Snapshot binario non leggibile: %s", self.binary_path)
+            return False
+        self.data = payload["data"]
+        self._binary_stamp = stamp
+        if header.get("catalog") != PRODUCT_CATALOG.digest:
+            self.rebuild_indexes()
+            return True
+        for name, value in payload["indexes"].items():
+            setattr(self, name, value)
+        RENDER_CACHE.invalidate_namespace(self.path)
+        self.version += 1
+        return True
+
+    def write_binary_snapshot(self) -> None:
+        if not BINARY_SNAPSHOTS or not self._stamp or self._binary_stamp == self._stamp:
+            return
+        header = {"format": BINARY_SNAPSHOT_FORMAT, "stamp": self._stamp, "catalog": PRODUCT_CATALOG.digest}
+        payload = {
+            "data": self.data,
+            "indexes": {
+                "by_id": self.by_id,
+                "positions": self.positions,
+                "change_log": self.change_log,
+                "fingerprints": self.fingerprints,
+                "raw_hashes": self.raw_hashes,
+                "customers": self.customers,
+                "order_ids": self.order_ids,
+                "pending_by_day": self.pending_by_day,
+                "pending_products": self.pending_products,
+                "pending_ids": self.pending_ids,
+                "created_index": self.created_index,
+                "undated_ids": self.undated_ids,
+                "words": self.words,
+            },
+        }
+        data_dir = os.path.dirname(self.binary_path)
+        with tempfile.NamedTemporaryFile("wb", dir=data_dir or ".", suffix=".tmp", delete=False) as handle:
+            pickle.dump(header, handle, protocol=5)
+            pickle.dump(payload, handle, protocol=5)
+            temp_path = handle.name
+        os.replace(temp_path, self.binary_path)
+        self._binary_stamp = self._stamp
+
+    def save(self) -> None:
+        data_dir = os.path.dirname(self.path)
+        if data_dir:
+            os.makedirs(data_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=data_dir or ".", suffix=".tmp", delete=False, encoding="utf-8"
+        ) as handle:
+            json.dump(self.data, handle, ensure_ascii=False, indent=2)
+            temp_path = handle.name
+        os.replace(temp_path, self.path)
+        self._stamp = self._file_stamp()
+        self.bytes_written += self._stamp[1]
+        if self.pending_events:
+            CHANGE_FEED.publish(self.pending_events)
+            self.pending_events = []
+
+    def _emit(self, event_type: str, order: Optional[dict] = None, **extra: object) -> None:
+        if not CHANGE_FEED.enabled:
+            return
+        event = {
+            "event": event_type,
+            "shard": self.shard_key,
+            "at": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            **extra,
+        }
+        if order is not None:
+            event["order_id"] = order["id"]
+            event["seq"] = order.get("seq")
+            event["order"] = {key: value for key, value in order.items() if key not in ("raw_text", "raw_ref")}
+        self.pending_events.append(event)
+
+    def snapshot(self) -> OrderSnapshot:
+        if self._snapshot is None or self._snapshot.version != self.version or self._snapshot.blobs is not self.blobs:
+            self._snapshot = OrderSnapshot(self.version, tuple(self.orders), self.blobs)
+        self._blobs_shared = True
+        return self._snapshot
+
+    def _next_seq(self) -> int:
+        seq = int(self.data.get("change_seq", 0)) + 1
+        self.data["change_seq"] = seq
+        return seq
+
+    @property
+    def cursor(self) -> int:
+        return int(self.data.get("change_seq", 0))
+
+    def render_order(self, order: Dict[str, str]) -> str:
+        return RENDER_CACHE.render(self.path, "card", order, format_order)
+
+    def render_order_line(self, order: Dict[str, str]) -> str:
+        return RENDER_CACHE.render(self.path, "line", order, format_order_line)
+
+    @property
+    def blobs(self) -> Dict[str, dict]:
+        return self.data.setdefault("blobs", {})
+
+    def _intern_raw_text(self, fields: Dict[str, object]) -> Dict[str, object]:
+        value = fields.get("raw_text") or ""
+        if len(value) <= RAW_TEXT_INLINE_LIMIT:
+            return fields
+        fields = {key: item for key, item in fields.items() if key != "raw_text"}
+        ref = hashlib.sha256(value.encode("utf-8")).hexdigest()[:20]
+        blob = self.blobs.get(ref)
+        if blob is None:
+            blob = self.blobs[ref] = {**compress_raw_text(value), "h": raw_text_hash(value), "n": 0}
+        blob["n"] += 1
+        fields["raw_ref"] = ref
+        return fields
+
+    def _release_raw_text(self, order: dict) -> None:
+        blob = self.blobs.get(order.get("raw_ref"))
+        if blob is None:
+            return
+        blob["n"] -= 1
+        if blob["n"] <= 0:
+            self._drop_blobs([order["raw_ref"]])
+
+    def _drop_blobs(self, refs: list[str]) -> None:
+        if not refs:
+            return
+        if self._blobs_shared:
+            self.data["blobs"] = dict(self.blobs)
+            self._blobs_shared = False
+        for ref in refs:
+            del self.blobs[ref]
+
+    def raw_text(self, order: Dict[str, object]) -> str:
+        return resolve_raw_text(order, self.blobs)
+
+    def raw_text_key(self, order: Dict[str, object]) -> Optional[str]:
+        return resolve_raw_text_key(order, self.blobs)
+
+    def rebuild_indexes(self) -> None:
+        RENDER_CACHE.invalidate_namespace(self.path)
+        self.version += 1
+        for blob in self.blobs.values():
+            blob["n"] = 0
+        for position, order in enumerate(self.orders):
+            if len(order.get("raw_text") or "") > RAW_TEXT_INLINE_LIMIT:
+                order = self.orders[position] = self._intern_raw_text(order)
+            elif order.get("raw_ref") in self.blobs:
+                self.blobs[order["raw_ref"]]["n"] += 1
+            if "seq" not in order:
+                order["seq"] = self._next_seq()
+        self._drop_blobs([ref for ref, blob in self.blobs.items() if blob["n"] <= 0])
+        self.change_log = sorted(
+            [(order["seq"], order["id"]) for order in self.orders]
+            + [(tombstone["seq"], tombstone["id"]) for tombstone in self.data.get("tombstones", [])]
+        )
+        self.positions = {str(order["id"]): position for position, order in enumerate(self.orders)}
+        self.by_id = {}
+        self.fingerprints = {}
+        self.raw_hashes = {}
+        self.customers = {}
+        self.order_ids = sorted(order["id"] for order in self.orders)
+        self.pending_by_day = {}
+        self.pending_products = {}
+        self.pending_ids = set()
+        self.created_index = []
+        self.undated_ids = set()
+        self.words = {}
+        for order in self.orders:
+            self._index_order(order)
+
+    def _index_order(self, order: dict) -> None:
+        self.by_id[str(order["id"])] = order
+        self.fingerprints.setdefault(order_fingerprint(order), []).append(order["id"])
+        raw_key = self.raw_text_key(order)
+        if raw_key:
+            self.raw_hashes.setdefault(raw_key, []).append(order["id"])
+        product_quantities = order_product_quantities(order)
+        self._index_customer(order, 1, product_quantities)
+        self._index_pending(order, 1, product_quantities)
+        self._index_search(order, 1)
+
+    def _unindex_order(self, order: dict) -> None:
+        self.by_id.pop(str(order["id"]), None)
+        product_quantities = order_product_quantities(order)
+        self._index_customer(order, -1, product_quantities)
+        self._index_pending(order, -1, product_quantities)
+        self._index_search(order, -1)
+        for index, key in (
+            (self.fingerprints, order_fingerprint(order)),
+            (self.raw_hashes, self.raw_text_key(order)),
+        ):
+            ids = index.get(key)
+            if not ids:
+                continue
+            if order["id"] in ids:
+                ids.remove(order["id"])
+            if not ids:
+                index.pop(key, None)
+
+    def _index_pending(self, order: dict, sign: int, product_quantities: list[Tuple[str, str, float, str]]) -> None:
+        if order.get("ready"):
+            return
+        if sign > 0:
+            self.pending_ids.add(order["id"])
+        else:
+            self.pending_ids.discard(order["id"])
+        day = order_date_key(order)[:10]
+        self.pending_by_day[day] = self.pending_by_day.get(day, 0) + sign
+        if self.pending_by_day[day] <= 0:
+            del self.pending_by_day[day]
+        for key, name, amount, unit in product_quantities:
+            product = self.pending_products.setdefault((key, unit), {"name": name, "amount": 0.0})
+            product["amount"] += sign * amount
+            if abs(product["amount"]) < 1e-9:
+                del self.pending_products[(key, unit)]
+
+    def _index_search(self, order: dict, sign: int) -> None:
+        created = parse_created_at(order.get("created_at", ""))
+        if created is None:
+            if sign > 0:
+                self.undated_ids.add(order["id"])
+            else:
+                self.undated_ids.discard(order["id"])
+        else:
+            entry = (created.isoformat(), order["id"])
+            if sign > 0:
+                bisect.insort(self.created_index, entry)
+            else:
+                position = bisect.bisect_left(self.created_index, entry)
+                if position < len(self.created_index) and self.created_index[position] == entry:
+                    del self.created_index[position]
+        for word in order_search_words(order):
+            if sign > 0:
+                self.words.setdefault(word, set()).add(order["id"])
+                continue
+            ids = self.words.get(word)
+            if ids is not None:
+                ids.discard(order["id"])
+                if not ids:
+                    del self.words[word]
+
+    def lookup_index(self, term: "QueryTerm") -> Optional[set]:
+        if term.kind == "id":
+            low, high = term.value
+            start = 0 if low is None else bisect.bisect_left(self.order_ids, low)
+            end = len(self.order_ids) if high is None else bisect.bisect_right(self.order_ids, high)
+            return set(self.order_ids[start:end])
+        if term.kind == "status":
+            return None if term.value else self.pending_ids
+        if term.kind == "created":
+            low, high = term.value
+            start = 0 if low is None else bisect.bisect_left(self.created_index, (low.isoformat(), -1))
+            end = (
+                len(self.created_index)
+                if high is None
+                else bisect.bisect_right(self.created_index, (high.isoformat(), float("inf")))
+            )
+            return {order_id for _, order_id in self.created_index[start:end]} | self.undated_ids
+        if term.kind == "customer":
+            ids: set = set()
+            for key in term.value:
+                customer = self.customers.get(key)
+                if customer:
+                    ids.update(order_id for _, order_id in customer["entries"])
+            return ids
+        if term.kind == "text":
+            tokens = term.value.split()
+            if not tokens:
+                return None
+            token = max(tokens, key=len)
+            ids = set()
+            for word, word_ids in self.words.items():
+                if token in word:
+                    ids |= word_ids
+            return ids
+        return None
+
+    def count_created_since(self, first_id: int) -> int:
+        return len(self.order_ids) - bisect.bisect_left(self.order_ids, first_id)
+
+    def _index_customer(
+        self, order: dict, sign: int, product_quantities: list[Tuple[str, str, float, str]]
+    ) -> None:
+        entry_key = (order_date_key(order), order["id"])
+        for customer_key in order_customer_keys(order):
+            customer = self.customers.get(customer_key)
+            if customer is None:
+                if sign < 0:
+                    continue
+                customer = self.customers[customer_key] = {"entries": [], "pending": 0, "products": {}}
+            if sign > 0:
+                bisect.insort(customer["entries"], entry_key)
+            else:
+                position = bisect.bisect_left(customer["entries"], entry_key)
+                if position == len(customer["entries"]) or customer["entries"][position] != entry_key:
+                    continue
+                del customer["entries"][position]
+            if not customer["entries"]:
+                del self.customers[customer_key]
+                continue
+            if not order.get("ready"):
+                customer["pending"] += sign
+            products = customer["products"]
+            for key, name, amount, unit in product_quantities:
+                product = products.setdefault((key, unit), {"name": name, "amount": 0.0})
+                product["amount"] += sign * amount
+                if abs(product["amount"]) < 1e-9:
+                    del products[(key, unit)]
+
+    def find_customer(self, value: str) -> Optional[Tuple[str, dict]]:
+        candidates = []
+        username = normalize_username(value)
+        if username:
+            candidates.append(f"u:{username}")
+        contact = normalize_contact(value)
+        if contact:
+            candidates.append(f"c:{contact}")
+        for customer_key in candidates:
+            customer = self.customers.get(customer_key)
+            if customer:
+                return customer_key, customer
+        return None
+
+    def get_order(self, order_id: object) -> Optional[dict]:
+        return self.by_id.get(str(order_id))
+
+    def find_duplicates(self, order: Dict[str, str]) -> list[dict]:
+        ids = list(self.fingerprints.get(order_fingerprint(order), []))
+        raw_key = self.raw_text_key(order)
+        if raw_key:
+            ids.extend(self.raw_hashes.get(raw_key, []))
+        seen = set()
+        duplicates = []
+        for order_id in ids:
+            if order_id in seen or order_id == order.get("id"):
+                continue
+            seen.add(order_id)
+            duplicate = self.get_order(order_id)
+            if duplicate:
+                duplicates.append(duplicate)
+        return duplicates
+
+    def create_order(self, fields: Dict[str, str]) -> dict:
+        order_id = self.data.get("next_id", 1)
+        order = {"id": order_id, **self._intern_raw_text(fields), "seq": self._next_seq()}
+        self.change_log.append((order["seq"], order_id))
+        self.positions[str(order_id)] = len(self.orders)
+        self.orders.append(order)
+        self.order_ids.append(order_id)
+        self.data["next_id"] = order_id + 1
+        self._index_order(order)
+        self.version += 1
+        self._emit("created", order)
+        return order
+
+    def update_order(self, order_id: object, fields: Dict[str, object]) -> Optional[dict]:
+        order = self.get_order(order_id)
+        if not order:
+            return None
+        base = order
+        if "raw_text" in fields:
+            base = {key: value for key, value in order.items() if key not in ("raw_text", "raw_ref")}
+        updated = {**base, **self._intern_raw_text(fields), "seq": self._next_seq()}
+        self.change_log.append((updated["seq"], updated["id"]))
+        RENDER_CACHE.invalidate(self.path, order["id"])
+        self._unindex_order(order)
+        if "raw_text" in fields:
+            self._release_raw_text(order)
+        self.orders[self.positions[str(order["id"])]] = updated
+        self._index_order(updated)
+        self.version += 1
+        self._emit("ready" if fields.get("ready") and not order.get("ready") else "updated", updated)
+        return updated
+
+    def delete_order(self, order_id: object) -> bool:
+        order = self.get_order(order_id)
+        if not order:
+            return False
+        RENDER_CACHE.invalidate(self.path, order["id"])
+        self._unindex_order(order)
+        self._release_raw_text(order)
+        self._add_tombstone(order["id"])
+        position = bisect.bisect_left(self.order_ids, order["id"])
+        if position < len(self.order_ids) and self.order_ids[position] == order["id"]:
+            del self.order_ids[position]
+        self.data["orders"] = [item for item in self.orders if item is not order]
+        self.positions = {str(item["id"]): position for position, item in enumerate(self.orders)}
+        self.version += 1
+        self._emit("deleted", order_id=order["id"], seq=self.cursor)
+        return True
+
+    def _add_tombstone(self, order_id: int) -> None:
+        tombstone = {
+            "id": order_id,
+            "seq": self._next_seq(),
+            "deleted_at": datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC"),
+        }
+        self.data.setdefault("tombstones", []).append(tombstone)
+        self.change_log.append((tombstone["seq"], order_id))
+
+    def replace_orders(self, orders: list[dict], next_id: Optional[int] = None, event: str = "imported") -> None:
+        imported_ids = {order["id"] for order in orders}
+        for order in self.orders:
+            if order["id"] not in imported_ids:
+                self._add_tombstone(order["id"])
+        next_id = max(next_id or 0, max((order["id"] for order in orders), default=0) + 1)
+        self.data = {
+            "next_id": next_id,
+            "change_seq": self.cursor,
+            "tombstones": self.data.get("tombstones", []),
+            "blobs": self.blobs,
+            "orders": orders,
+        }
+        for order in orders:
+            order["seq"] = self._next_seq()
+        self.rebuild_indexes()
+        self._emit(event, count=len(orders), seq=self.cursor)
+
+    def changes_since(self, since: int) -> Tuple[list[dict], list[dict], int]:
+        position = bisect.bisect_right(self.change_log, (since, float("inf")))
+        changed: Dict[int, dict] = {}
+        deleted: Dict[int, int] = {}
+        for seq, order_id in self.change_log[position:]:
+            order = self.get_order(order_id)
+            if order is None:
+                deleted[order_id] = seq
+            elif order["seq"] == seq:
+                changed[order_id] = order
+        orders = sorted(changed.values(), key=lambda order: order["seq"])
+        tombstones = [{"id": order_id, "seq": seq} for order_id, seq in sorted(deleted.items(), key=lambda item: item[1])]
+        return orders, tombstones, self.cursor
+
+
+class ShardRegistry:
+    def __init__(self, max_loaded: int) -> None:
+        self.max_loaded = max(1, max_loaded)
+        self.stores: "OrderedDict[str, OrderStore]" = OrderedDict()
+        self.evicted_bytes = 0
+        self.retiring: set = set()
+
+    @property
+    def bytes_written(self) -> int:
+        return self.evicted_bytes + sum(store.bytes_written for store in self.stores.values())
+
+    def get(self, key: str) -> OrderStore:
+        key = canonical_shard_key(key)
+        if PRODUCT_CATALOG.load():
+            for loaded_store in self.stores.values():
+                loaded_store.rebuild_indexes()
+        store = self.stores.get(key)
+        if store is None:
+            store = OrderStore(shard_path(key), key)
+            self.stores[key] = store
+            self._evict_idle()
+        else:
+            self.stores.move_to_end(key)
+        store.load()
+        return store
+
+    def warm_up(self) -> list[OrderStore]:
+        stores = [self.get(key) for key in list_shard_keys()[: self.max_loaded]]
+        for store in stores:
+            store.write_binary_snapshot()
+        return stores
+
+    def write_snapshots(self) -> None:
+        for store in list(self.stores.values()):
+            store.write_binary_snapshot()
+
+    def _evict_idle(self) -> None:
+        for key in list(self.stores):
+            if len(self.stores) <= self.max_loaded:
+                return
+            store = self.stores[key]
+            if store.lock.locked():
+                continue
+            self.evicted_bytes += store.bytes_written
+            del self.stores[key]
+            self._retire(store)
+            logger.info("Shard %s scaricato dalla memoria", key)
+
+    def _retire(self, store: OrderStore) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._close_store(store)
+            return
+        task = loop.create_task(asyncio.to_thread(self._close_store, store))
+        self.retiring.add(task)
+        task.add_done_callback(self.retiring.discard)
+
+    @staticmethod
+    def _close_store(store: OrderStore) -> None:
+        try:
+            store.write_binary_snapshot()
+        except Exception:
+            logger.exception("Snapshot binario non scritto per lo shard %s", store.shard_key)
+        finally:
+            store.close()
+
+
+def shard_key_for(update: Update) -> str:
+    if ORDERS_SHARD_BY not in ("chat", "team"):
+        return DEFAULT_SHARD
+    chat = update.effective_chat
+    chat_id = chat.id if chat else 0
+    if ORDERS_SHARD_BY == "team" and chat_id in ORDERS_TEAMS:
+        return canonical_shard_key(f"team-{ORDERS_TEAMS[chat_id]}")
+    return f"chat{chat_id}"
+
 
+def canonical_shard_key(key: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_-]", "_", key)
 
-def save_orders(data: Dict[str, dict]) -> None:
-    data_dir = os.path.dirname(DATA_PATH)
-    if data_dir:
-        os.makedirs(data_dir, exist_ok=True)
-    with open(DATA_PATH, "w", encoding="utf-8") as handle:
-        json.dump(data, handle, ensure_ascii=False, indent=2)
+
+def shard_path(key: str) -> str:
+    key = canonical_shard_key(key)
+    if key == DEFAULT_SHARD:
+        return DATA_PATH
+    return os.path.join(SHARDS_DIR, f"{key}.json")
+
+
+ORDER_SHARDS = ShardRegistry(MAX_LOADED_SHARDS)
+
+
+def load_store(update: Update) -> OrderStore:
+    return ORDER_SHARDS.get(shard_key_for(update))
+
+
+def load_snapshot(update: Update) -> OrderSnapshot:
+    return load_store(update).snapshot()
+
+
+def find_duplicate_clusters(
+    orders: Iterable[Dict[str, str]], raw_key: Optional[Callable[[dict], Optional[str]]] = None
+) -> list[Tuple[list[int], list[str]]]:
+    parents: Dict[int, int] = {}
+    reasons: Dict[int, set] = {}
+
+    def find(order_id: int) -> int:
+        while parents[order_id] != order_id:
+            parents[order_id] = parents[parents[order_id]]
+            order_id = parents[order_id]
+        return order_id
+
+    def union(first: int, second: int, reason: str) -> None:
+        root_first, root_second = find(first), find(second)
+        if root_first != root_second:
+            parents[root_second] = root_first
+            reasons[root_first] = reasons.get(root_first, set()) | reasons.pop(root_second, set())
+        reasons.setdefault(root_first, set()).add(reason)
+
+    seen_fingerprints: Dict[str, int] = {}
+    seen_raw: Dict[str, int] = {}
+    for order in orders:
+        order_id = order["id"]
+        parents.setdefault(order_id, order_id)
+        fingerprint = order_fingerprint(order)
+        if fingerprint in seen_fingerprints:
+            union(seen_fingerprints[fingerprint], order_id, "stessi dati")
+        else:
+            seen_fingerprints[fingerprint] = order_id
+        raw_hash = raw_key(order) if raw_key else (raw_text_hash(order["raw_text"]) if order.get("raw_text") else None)
+        if raw_hash:
+            if raw_hash in seen_raw:
+                union(seen_raw[raw_hash], order_id, "stesso testo")
+            else:
+                seen_raw[raw_hash] = order_id
+    clusters: Dict[int, list[int]] = {}
+    for order_id in parents:
+        clusters.setdefault(find(order_id), []).append(order_id)
+    return [
+        (sorted(ids), sorted(reasons.get(root, set())))
+        for root, ids in sorted(clusters.items(), key=lambda item: min(item[1]))
+        if len(ids) > 1
+    ]
+
+
+ORDER_SEPARATOR_REGEX = re.compile(r"^\s*---\s*$")
+NUMBERED_BLOCK_REGEX = re.compile(r"^\s*\d+\.\s+")
+
+
+def iter_order_blocks(lines: Iterable[str], max_chars: int = 0) -> Iterator[str]:
+    block: list[str] = []
+    size = 0
+    for line in lines:
+        if ORDER_SEPARATOR_REGEX.match(line):
+            text = "".join(block).strip()
+            if text:
+                yield text
+            block, size = [], 0
+        elif not max_chars or size < max_chars:
+            block.append(line)
+            size += len(line)
+    text = "".join(block).strip()
+    if text:
+        yield text
+
+
+def iter_numbered_blocks(lines: Iterable[str], max_chars: int = 0) -> Iterator[str]:
+    block: Optional[list[str]] = None
+    size = 0
+    absorbing = False
+    for line in lines:
+        match = NUMBERED_BLOCK_REGEX.match(line)
+        if absorbing:
+            absorbing = not line.strip()
+            if match and line[:1].isspace():
+                match = None
+        if match:
+            absorbing = match.end() == len(line)
+            if block:
+                text = "".join(block).strip()
+                if text:
+                    yield text
+            block, size = [line], len(line)
+        elif block is not None and (not max_chars or size < max_chars):
+            block.append(line)
+            size += len(line)
+    if block:
+        text = "".join(block).strip()
+        if text:
+            yield text
+
+
+def iter_text_lines(text: str) -> Iterator[str]:
+    start = 0
+    while True:
+        end = text.find("\n", start)
+        if end < 0:
+            if start < len(text):
+                yield text[start:]
+            return
+        yield text[start : end + 1]
+        start = end + 1
 
 
 def split_order_blocks(text: str) -> list[str]:
-    parts = re.split(r"^\s*---\s*$", text, flags=re.MULTILINE)
-    return [part.strip() for part in parts if part.strip()]
+    return list(iter_order_blocks(iter_text_lines(text)))
 
 
 def split_numbered_blocks(text: str) -> list[str]:
-    matches = list(re.finditer(r"^\s*\d+\.\s+", text, flags=re.MULTILINE))
-    if not matches:
-        return []
-    blocks = []
-    for index, match in enumerate(matches):
-        start = match.start()
-        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
-        block = text[start:end].strip()
-        if block:
-            blocks.append(block)
-    return blocks
+    return list(iter_numbered_blocks(iter_text_lines(text)))
+
+
+@lru_cache(maxsize=DATE_TOKEN_CACHE_SIZE)
+def parse_date_token(date_token: str) -> Optional[str]:
+    if len(date_token) == 10 and date_token[4] == "-":
+        year, month, day = int(date_token[:4]), int(date_token[5:7]), int(date_token[8:])
+    else:
+        if date_token[2] != date_token[5] or len(date_token) not in (8, 10):
+            return None
+        day, month, year = int(date_token[:2]), int(date_token[3:5]), int(date_token[6:])
+        if len(date_token) == 8:
+            year += 1900 if year >= 69 else 2000
+    try:
+        date(year, month, day)
+    except ValueError:
+        return None
+    return f"{year}-{month:02d}-{day:02d}"
 
 
 def parse_date_from_text(value: str) -> Optional[str]:
-    candidate = value.strip()
-    match = DATE_LINE_REGEX.search(candidate)
-    if not match:
-        return None
-    date_token = match.group(1)
-    for fmt in DATE_LINE_FORMATS:
-        try:
-            parsed_date = datetime.strptime(date_token, fmt).date()
-            return parsed_date.strftime("%Y-%m-%d")
-        except ValueError:
-            continue
-    return None
+    match = DATE_LINE_REGEX.search(value)
+    return parse_date_token(match.group(1)) if match else None
 
 
-def parse_numbered_order_block(text: str) -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+def parse_dates_from_texts(values: Iterable[str]) -> list[Optional[str]]:
+    search, parse_token = DATE_LINE_REGEX.search, parse_date_token
+    return [parse_token(match.group(1)) if (match := search(value)) else None for value in values]
+
+
+@instrumented_parser("numbered")
+def parse_numbered_order_fields(text: str) -> Tuple[Optional[Dict[str, str]], Tuple[str, ...]]:
+    counters = PARSER_METRICS.counters if PARSER_METRICS.enabled else None
     lines = [line.strip() for line in text.splitlines() if line.strip()]
     if not lines:
         return None, None
     header = re.sub(r"^\s*\d+\.\s*", "", lines[0]).lstrip("•").strip()
     parts = [part.strip() for part in header.split("|") if part.strip()]
     if len(parts) < 2:
-        return None, None
+        if counters is not None:
+            counters["numbered:header_rejected"] += 1
+        return None, ()
     username_raw = parts[0]
     prodotti_raw = parts[1]
     quantity_match = re.search(r"\(([^)]+)\)\s*$", prodotti_raw)
     quantita = quantity_match.group(1).strip() if quantity_match else ""
     prodotti = re.sub(r"\(([^)]+)\)\s*$", "", prodotti_raw).strip()
     if not prodotti:
-        return None, None
+        return None, ()
     parsed = {
         "username_telegram": username_raw if username_raw.startswith("@") else f"@{username_raw}",
         "prodotti": prodotti,
@@ -150,9 +1376,11 @@ def parse_numbered_order_block(text: str) -> Tuple[Optional[Dict[str, str]], Opt
     if quantita:
         parsed["quantita"] = quantita
     details_text = " ".join(lines[1:]).replace("•", "").strip()
-    date_override = None
+    date_candidates: Tuple[str, ...] = ()
     if details_text:
         detail_parts = [part.strip() for part in details_text.split("|") if part.strip()]
+        if counters is not None:
+            counters[f"numbered:detail_parts_{min(len(detail_parts), 4)}"] += 1
         if detail_parts:
             parsed.setdefault("indirizzo", detail_parts[0])
             if len(detail_parts) > 1:
@@ -160,7 +1388,7 @@ def parse_numbered_order_block(text: str) -> Tuple[Optional[Dict[str, str]], Opt
             if len(detail_parts) > 2:
                 parsed.setdefault("contatto", detail_parts[2])
             if len(detail_parts) > 3:
-                date_override = parse_date_from_text(detail_parts[3])
+                date_candidates = (detail_parts[3],)
         if not parsed.get("indirizzo"):
             parsed["indirizzo"] = details_text
         if not parsed.get("contatto"):
@@ -170,23 +1398,52 @@ def parse_numbered_order_block(text: str) -> Tuple[Optional[Dict[str, str]], Opt
                 parsed["contatto"] = email_match.group(0)
             elif phone_match:
                 parsed["contatto"] = phone_match.group(0)
-        if not date_override:
-            date_override = parse_date_from_text(details_text)
+            if counters is not None:
+                counters["numbered:contact_regex"] += 1
+        date_candidates += (details_text,)
     if not parsed.get("metodo_pagamento"):
         parsed["metodo_pagamento"] = "N/D"
-    return parsed, date_override
+    return parsed, date_candidates
+
+
+def parse_numbered_order_blocks(blocks: list[str]) -> list[Tuple[Optional[Dict[str, str]], Optional[str]]]:
+    fields = [parse_numbered_order_fields(block) for block in blocks]
+    dates = parse_dates_from_texts(candidates[0] if candidates else "" for _, candidates in fields)
+    retry = [position for position, (_, candidates) in enumerate(fields) if len(candidates) > 1 and not dates[position]]
+    for position, date_override in zip(retry, parse_dates_from_texts(fields[position][1][1] for position in retry)):
+        dates[position] = date_override
+    if PARSER_METRICS.enabled:
+        from_details = len(retry) + sum(1 for _, candidates in fields if len(candidates) == 1)
+        PARSER_METRICS.counters["numbered:date_from_details"] += from_details
+    return [(parsed, date_override) for (parsed, _), date_override in zip(fields, dates)]
+
+
+def parse_numbered_order_block(text: str) -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+    return parse_numbered_order_blocks([text])[0]
 
 
 def parse_numbered_orders_message(text: str) -> list[Tuple[str, Dict[str, str], Optional[str]]]:
-    parsed_blocks: list[Tuple[str, Dict[str, str], Optional[str]]] = []
-    for block in split_numbered_blocks(text):
-        parsed, date_override = parse_numbered_order_block(block)
-        if parsed:
-            parsed_blocks.append((block, parsed, date_override))
+    blocks = split_numbered_blocks(text)
+    return [
+        (block, parsed, date_override)
+        for block, (parsed, date_override) in zip(blocks, parse_numbered_order_blocks(blocks))
+        if parsed
+    ]
+
+
+def parse_message_blocks(text: str) -> list[Tuple[str, Dict[str, str], Optional[str]]]:
+    parsed_blocks = parse_numbered_orders_message(text)
+    if not parsed_blocks:
+        for block in split_order_blocks(text):
+            parsed, date_override = parse_order_message(block)
+            if parsed:
+                parsed_blocks.append((block, parsed, date_override))
     return parsed_blocks
 
 
+@instrumented_parser("form")
 def parse_order_message(text: str) -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+    counters = PARSER_METRICS.counters if PARSER_METRICS.enabled else None
     parsed: Dict[str, str] = {}
     date_override: Optional[str] = None
     in_shipping_section = False
@@ -283,34 +1540,41 @@ def parse_order_message(text: str) -> Tuple[Optional[Dict[str, str]], Optional[s
         return bool(re.fullmatch(r"[A-Za-zÀ-ÿ'’.\- ]+", value.strip()))
 
     def assign_unlabeled_value(unlabeled_value: str, section: str) -> None:
+        branch = assign_unlabeled_branch(unlabeled_value, section)
+        if counters is not None:
+            counters[f"unlabeled:{section}:{branch}"] += 1
+
+    def assign_unlabeled_branch(unlabeled_value: str, section: str) -> str:
         if not unlabeled_value:
-            return
+            return "empty"
         if "username_telegram" not in parsed and looks_like_username(unlabeled_value):
             parsed["username_telegram"] = ensure_username_prefix(unlabeled_value)
-            return
+            return "looks_like_username"
         if section in ("shipping", "general") and "contatto" not in parsed:
             if email_regex.search(unlabeled_value) or phone_regex.search(unlabeled_value):
                 parsed["contatto"] = unlabeled_value
-                return
+                return "contact_regex"
         if section in ("order", "general"):
             if "metodo_pagamento" not in parsed and looks_like_payment(unlabeled_value):
                 parsed["metodo_pagamento"] = unlabeled_value
-                return
+                return "looks_like_payment"
             if "quantita" not in parsed and looks_like_quantity(unlabeled_value):
                 parsed["quantita"] = unlabeled_value
-                return
+                return "looks_like_quantity"
             if "prodotti" not in parsed:
                 parsed["prodotti"] = unlabeled_value
-                return
+                return "prodotti_fallback"
         if section in ("shipping", "general"):
             if "indirizzo" not in parsed and looks_like_address(unlabeled_value):
                 parsed["indirizzo"] = unlabeled_value
-                return
+                return "looks_like_address"
         if section in ("shipping", "general") and "nome_cognome" not in parsed and looks_like_name(unlabeled_value):
             parsed["nome_cognome"] = unlabeled_value
-            return
+            return "looks_like_name"
         if section == "shipping" and "nome_cognome" not in parsed:
             parsed["nome_cognome"] = unlabeled_value
+            return "nome_fallback"
+        return "unassigned"
 
     label_patterns = [
         (
@@ -325,25 +1589,33 @@ def parse_order_message(text: str) -> Tuple[Optional[Dict[str, str]], Optional[s
         line = raw_line.strip()
         if not line:
             continue
-        date_candidate = clean_unlabeled(line.replace(":", ""))
-        date_match = DATE_LINE_REGEX.search(date_candidate)
-        if date_match and date_override is None:
-            parsed_date = parse_date_from_text(date_candidate)
+        if date_override is None:
+            parsed_date = parse_date_from_text(clean_unlabeled(line.replace(":", "")))
             if parsed_date:
                 date_override = parsed_date
+                if counters is not None:
+                    counters["line:date"] += 1
                 continue
         if "informazioni spedizione" in line.lower():
             in_shipping_section = True
             in_order_section = False
+            if counters is not None:
+                counters["line:section_shipping"] += 1
             continue
         if "informazioni ordine" in line.lower():
             in_order_section = True
             in_shipping_section = False
+            if counters is not None:
+                counters["line:section_order"] += 1
             continue
         if "informazioni" in line.lower():
+            if counters is not None:
+                counters["line:section_other"] += 1
             continue
         if looks_like_username(line) and "username_telegram" not in parsed:
             parsed["username_telegram"] = ensure_username_prefix(clean_unlabeled(line))
+            if counters is not None:
+                counters["line:username"] += 1
             continue
         for label, field_key, pattern in label_patterns:
             if not field_key:
@@ -351,8 +1623,12 @@ def parse_order_message(text: str) -> Tuple[Optional[Dict[str, str]], Optional[s
             match = pattern.match(line)
             if not match:
                 continue
+            if counters is not None:
+                counters[f"label:{label}"] += 1
             value = match.group(1).strip()
             if not value:
+                if counters is not None:
+                    counters["label:lookahead"] += 1
                 for next_line in lines[index + 1 :]:
                     next_value = next_line.strip()
                     if not next_value or "informazioni" in next_value.lower():
@@ -417,60 +1693,317 @@ def format_order_date(order: Dict[str, str]) -> str:
     return parsed.strftime("%b %d %Y").replace(" 0", " ")
 
 
-def extract_list_options(args: list[str]) -> Tuple[Optional[str], Optional[bool], Optional[date], Optional[date]]:
-    query_parts: list[str] = []
-    ready_filter: Optional[bool] = None
-    from_date: Optional[date] = None
-    to_date: Optional[date] = None
+class QueryError(ValueError):
+    pass
+
+
+class QueryTerm(NamedTuple):
+    kind: str
+    value: object
+    predicate: Callable[[dict], bool]
+
+
+QUERY_FIELDS = {
+    **{key: key for key in ORDER_FIELDS},
+    "id": "id",
+    "status": "status",
+    "stato": "status",
+    "created": "created",
+    "creato": "created",
+    "date": "created",
+    "data": "created",
+    "put": "put",
+    "put_date": "put",
+    "consegna": "put",
+    "customer": "customer",
+    "cliente": "customer",
+    "text": "text",
+    "testo": "text",
+    "user": "username_telegram",
+    "username": "username_telegram",
+    "prodotto": "prodotti",
+    "product": "prodotti",
+    "qty": "quantita",
+    "pagamento": "metodo_pagamento",
+    "nome": "nome_cognome",
+    "sender": "sender",
+    "sort": "sort",
+    "limit": "limit",
+}
+QUERY_STATUS_VALUES = {
+    "ready": True,
+    "pronto": True,
+    "pronti": True,
+    "pending": False,
+    "sospeso": False,
+    "sospesi": False,
+    "attesa": False,
+}
+QUERY_TOKEN_REGEX = re.compile(r'\(|\)|"[^"]*"?|[^\s()"]+(?:"[^"]*"?)?')
+INDEXED_QUERY_TERMS = ("id", "status", "created", "customer", "text")
+
+
+def order_search_words(order: Dict[str, object]) -> set:
+    username = str(order.get("username_telegram") or order.get("sender") or "").lower()
+    prodotti = str(order.get("prodotti") or "").lower()
+    return {*username.split(), *prodotti.split(), "ready" if order.get("ready") else "pending"}
+
+
+def parse_query_date(value: str) -> date:
+    parsed = parse_date(value)
+    if parsed is None:
+        normalized = parse_date_from_text(value)
+        parsed = parse_date(normalized) if normalized else None
+    if parsed is None:
+        raise QueryError(f"data non valida '{value}'")
+    return parsed
+
+
+def parse_query_range(value: str, parse_bound: Callable[[str], object], step: object) -> Tuple[object, object]:
+    for prefix in (">=", "<=", ">", "<"):
+        if value.startswith(prefix):
+            bound = parse_bound(value[len(prefix) :])
+            if prefix == ">=":
+                return bound, None
+            if prefix == "<=":
+                return None, bound
+            return (bound + step, None) if prefix == ">" else (None, bound - step)
+    if ".." in value:
+        low, high = value.split("..", 1)
+        return (parse_bound(low) if low else None), (parse_bound(high) if high else None)
+    bound = parse_bound(value)
+    return bound, bound
+
+
+def parse_query_id(value: str) -> int:
+    if not value.isdigit():
+        raise QueryError(f"id non valido '{value}'")
+    return int(value)
+
+
+def in_range(value: object, low: object, high: object) -> bool:
+    return (low is None or value >= low) and (high is None or value <= high)
+
+
+def text_query_term(phrase: str) -> QueryTerm:
+    lowered = phrase.lower()
+
+    def predicate(order: dict) -> bool:
+        username = (order.get("username_telegram") or order.get("sender") or "").lower()
+        prodotti = (order.get("prodotti") or "").lower()
+        status = "ready" if order.get("ready") else "pending"
+        return lowered in username or lowered in prodotti or lowered in status
+
+    return QueryTerm("text", lowered, predicate)
+
+
+def status_query_term(ready: bool) -> QueryTerm:
+    return QueryTerm("status", ready, lambda order: bool(order.get("ready")) == ready)
+
+
+def created_query_term(low: Optional[date], high: Optional[date]) -> QueryTerm:
+    def predicate(order: dict) -> bool:
+        created = parse_created_at(order.get("created_at", ""))
+        return created is None or in_range(created, low, high)
+
+    return QueryTerm("created", (low, high), predicate)
+
+
+def field_query_term(field: str, value: str) -> QueryTerm:
+    if field == "text":
+        return text_query_term(value)
+    if field == "status":
+        if value.lower() not in QUERY_STATUS_VALUES:
+            raise QueryError(f"stato non valido '{value}' (usa ready o pending)")
+        return status_query_term(QUERY_STATUS_VALUES[value.lower()])
+    if field == "id":
+        low, high = parse_query_range(value, parse_query_id, 1)
+        return QueryTerm("id", (low, high), lambda order: in_range(order["id"], low, high))
+    if field == "created":
+        return created_query_term(*parse_query_range(value, parse_query_date, timedelta(days=1)))
+    if field == "put":
+        low, high = parse_query_range(value, parse_query_date, timedelta(days=1))
+
+        def put_predicate(order: dict) -> bool:
+            put_date = parse_date(order.get("put_date") or "")
+            return put_date is not None and in_range(put_date, low, high)
+
+        return QueryTerm("put", (low, high), put_predicate)
+    if field == "customer":
+        keys = tuple(
+            key
+            for key in (
+                f"u:{normalize_username(value)}" if normalize_username(value) else None,
+                f"c:{normalize_contact(value)}" if normalize_contact(value) else None,
+            )
+            if key
+        )
+        if not keys:
+            raise QueryError(f"cliente non valido '{value}'")
+        return QueryTerm("customer", keys, lambda order: any(key in order_customer_keys(order) for key in keys))
+    needle = value.lower()
+    return QueryTerm("field", (field, needle), lambda order: needle in str(order.get(field) or "").lower())
+
+
+QUERY_SORT_KEYS: Dict[str, Callable[[dict], object]] = {
+    "id": lambda order: order["id"],
+    "created": lambda order: parse_created_at(order.get("created_at", "")) or date.min,
+    "put": lambda order: parse_date(order.get("put_date") or "") or date.min,
+}
+
+
+class QueryPlan(NamedTuple):
+    predicate: Callable[[dict], bool]
+    index_terms: Tuple[QueryTerm, ...]
+    sort_key: Optional[Callable[[dict], object]]
+    descending: bool
+    limit: Optional[int]
+
+    def select(self, store: "OrderStore") -> Iterable[dict]:
+        best: Optional[set] = None
+        for term in self.index_terms:
+            ids = store.lookup_index(term)
+            if ids is not None and (best is None or len(ids) < len(best)):
+                best = ids
+        if best is None:
+            return store.snapshot().orders
+        orders = [order for order in map(store.get_order, best) if order is not None]
+        orders.sort(key=lambda order: store.positions.get(str(order["id"]), 0))
+        return orders
+
+    def apply(self, orders: Iterable[dict]) -> list[dict]:
+        selected = [order for order in orders if self.predicate(order)]
+        if self.sort_key:
+            selected.sort(key=self.sort_key, reverse=self.descending)
+        return selected[: self.limit] if self.limit is not None else selected
+
+    def run(self, store: "OrderStore") -> list[dict]:
+        return self.apply(self.select(store))
+
+
+def compile_query(args: Iterable[str]) -> QueryPlan:
+    return compile_query_text(" ".join(args).strip())
+
+
+@lru_cache(maxsize=256)
+def compile_query_text(text: str) -> QueryPlan:
+    tokens = QUERY_TOKEN_REGEX.findall(text)
+    items: list[Tuple[str, Optional[QueryTerm]]] = []
+    words: list[str] = []
+    sort_key = None
+    descending = False
+    limit = None
+
+    def flush_words() -> None:
+        if words:
+            items.append(("term", text_query_term(" ".join(words))))
+            words.clear()
+
     index = 0
-    while index < len(args):
-        arg = args[index]
-        if arg == "--ready":
-            ready_filter = True
-        elif arg == "--pending":
-            ready_filter = False
-        elif arg == "--from" and index + 1 < len(args):
-            parsed = parse_date(args[index + 1])
-            if parsed:
-                from_date = parsed
+    while index < len(tokens):
+        token = tokens[index]
+        index += 1
+        if token in ("--ready", "--pending"):
+            flush_words()
+            items.append(("term", status_query_term(token == "--ready")))
+            continue
+        if token in ("--from", "--to") and index < len(tokens):
+            parsed = parse_date(tokens[index])
             index += 1
-        elif arg == "--to" and index + 1 < len(args):
-            parsed = parse_date(args[index + 1])
             if parsed:
-                to_date = parsed
-            index += 1
-        else:
-            query_parts.append(arg)
-        index += 1
-    query = " ".join(query_parts).strip() or None
-    return query, ready_filter, from_date, to_date
-
-
-def filter_orders(
-    orders: Iterable[Dict[str, str]],
-    query: Optional[str],
-    ready_filter: Optional[bool],
-    from_date: Optional[date],
-    to_date: Optional[date],
-) -> list[Dict[str, str]]:
-    filtered: list[Dict[str, str]] = []
-    for order in orders:
-        if ready_filter is not None and bool(order.get("ready")) != ready_filter:
+                flush_words()
+                items.append(("term", created_query_term(*((parsed, None) if token == "--from" else (None, parsed)))))
             continue
-        created_date = parse_created_at(order.get("created_at", ""))
-        if from_date and created_date and created_date < from_date:
+        if token in ("(", ")", "OR", "NOT"):
+            flush_words()
+            items.append((token, None))
             continue
-        if to_date and created_date and created_date > to_date:
+        negate = token.startswith("-") and len(token) > 1 and not token.startswith("--")
+        body = token[1:] if negate else token
+        name, _, value = body.partition(":")
+        field = QUERY_FIELDS.get(name.lower()) if value else None
+        if field is None and not negate and not body.startswith('"'):
+            words.append(token)
             continue
-        if query:
-            lowered = query.lower()
-            username = (order.get("username_telegram") or order.get("sender") or "").lower()
-            prodotti = (order.get("prodotti") or "").lower()
-            status = "ready" if order.get("ready") else "pending"
-            if lowered not in username and lowered not in prodotti and lowered not in status:
+        flush_words()
+        if field is None:
+            term = text_query_term(body.strip('"'))
+        else:
+            value = value.strip('"')
+            if field == "sort":
+                sort_name, _, direction = value.lower().lstrip("-").partition(":")
+                sort_name = QUERY_FIELDS.get(sort_name, sort_name)
+                if sort_name not in QUERY_SORT_KEYS:
+                    raise QueryError(f"ordinamento non valido '{value}' (usa id, created o put)")
+                sort_key = QUERY_SORT_KEYS[sort_name]
+                descending = value.startswith("-") or direction == "desc"
+                continue
+            if field == "limit":
+                if not value.isdigit() or int(value) == 0:
+                    raise QueryError(f"limite non valido '{value}'")
+                limit = int(value)
                 continue
-        filtered.append(order)
-    return filtered
+            term = field_query_term(field, value)
+        if negate:
+            items.append(("NOT", None))
+        items.append(("term", term))
+    flush_words()
+
+    position = 0
+
+    def parse_or() -> tuple:
+        nonlocal position
+        branches = [parse_and()]
+        while position < len(items) and items[position][0] == "OR":
+            position += 1
+            branches.append(parse_and())
+        return branches[0] if len(branches) == 1 else ("or", branches)
+
+    def parse_and() -> tuple:
+        parts = []
+        while position < len(items) and items[position][0] not in ("OR", ")"):
+            parts.append(parse_unary())
+        if not parts:
+            raise QueryError("espressione vuota")
+        return parts[0] if len(parts) == 1 else ("and", parts)
+
+    def parse_unary() -> tuple:
+        nonlocal position
+        kind, term = items[position]
+        position += 1
+        if kind == "NOT":
+            if position >= len(items):
+                raise QueryError("NOT senza condizione")
+            return ("not", parse_unary())
+        if kind == "(":
+            node = parse_or()
+            if position >= len(items) or items[position][0] != ")":
+                raise QueryError("parentesi non chiusa")
+            position += 1
+            return node
+        return ("term", term)
+
+    def build_predicate(node: tuple) -> Callable[[dict], bool]:
+        if node[0] == "term":
+            return node[1].predicate
+        if node[0] == "not":
+            inner = build_predicate(node[1])
+            return lambda order: not inner(order)
+        predicates = [build_predicate(child) for child in node[1]]
+        if node[0] == "and":
+            return lambda order: all(predicate(order) for predicate in predicates)
+        return lambda order: any(predicate(order) for predicate in predicates)
+
+    if not items:
+        return QueryPlan(lambda order: True, (), sort_key, descending, limit)
+    root = parse_or()
+    if position < len(items):
+        raise QueryError("parentesi non bilanciate")
+    conjuncts = root[1] if root[0] == "and" else [root]
+    index_terms = tuple(
+        node[1] for node in conjuncts if node[0] == "term" and node[1].kind in INDEXED_QUERY_TERMS
+    )
+    return QueryPlan(build_predicate(root), index_terms, sort_key, descending, limit)
 
 
 def build_value_suggestions(field_key: str, orders: Iterable[Dict[str, str]], limit: int = 3) -> list[str]:
@@ -539,6 +2072,192 @@ def parse_quantity_value(value: str) -> Tuple[Optional[float], str]:
     return number, unit
 
 
+UNIT_CONVERSIONS = {
+    "": ("pz", 1.0),
+    "pz": ("pz", 1.0),
+    "pezzi": ("pz", 1.0),
+    "pezzo": ("pz", 1.0),
+    "x": ("pz", 1.0),
+    "mg": ("g", 0.001),
+    "g": ("g", 1.0),
+    "gr": ("g", 1.0),
+    "kg": ("g", 1000.0),
+    "oz": ("g", 28.349523125),
+    "ml": ("ml", 1.0),
+    "cl": ("ml", 10.0),
+    "l": ("ml", 1000.0),
+}
+
+EMBEDDED_QUANTITY_REGEX = re.compile(r"\b\d+(?:[.,]\d+)?\s*(?:mg|gr|g|kg|ml|cl|l|pz|pezzi|x|oz)\b", re.IGNORECASE)
+
+
+def normalize_unit(amount: float, unit: str) -> Tuple[float, str]:
+    base_unit, factor = UNIT_CONVERSIONS.get(unit, (unit, 1.0))
+    return amount * factor, base_unit
+
+
+def format_quantity(amount: float, base_unit: str) -> str:
+    if base_unit == "g" and amount >= 1000:
+        return f"{format_amount(amount / 1000)}kg"
+    if base_unit == "g" and 0 < amount < 1:
+        return f"{format_amount(amount * 1000)}mg"
+    if base_unit == "ml" and amount >= 1000:
+        return f"{format_amount(amount / 1000)}l"
+    return f"{format_amount(amount)}{base_unit}"
+
+
+class ProductMatcher:
+    def __init__(self, patterns: Dict[str, str]) -> None:
+        self.transitions: list[Dict[str, int]] = [{}]
+        self.outputs: list[list[Tuple[int, str]]] = [[]]
+        for pattern, product_id in patterns.items():
+            node = 0
+            for char in pattern:
+                next_node = self.transitions[node].get(char)
+                if next_node is None:
+                    next_node = len(self.transitions)
+                    self.transitions[node][char] = next_node
+                    self.transitions.append({})
+                    self.outputs.append([])
+                node = next_node
+            self.outputs[node].append((len(pattern), product_id))
+        self.failures = [0] * len(self.transitions)
+        queue = list(self.transitions[0].values())
+        for node in queue:
+            for char, next_node in self.transitions[node].items():
+                queue.append(next_node)
+                failure = self.failures[node]
+                while failure and char not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                target = self.transitions[failure].get(char, 0)
+                self.failures[next_node] = target if target != next_node else 0
+                self.outputs[next_node] = self.outputs[next_node] + self.outputs[self.failures[next_node]]
+
+    def find(self, text: str) -> Optional[str]:
+        best: Optional[Tuple[int, int, str]] = None
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in self.transitions[node]:
+                node = self.failures[node]
+            node = self.transitions[node].get(char, 0)
+            for length, product_id in self.outputs[node]:
+                start = index - length + 1
+                if start > 0 and text[start - 1].isalnum():
+                    continue
+                if index + 1 < len(text) and text[index + 1].isalnum():
+                    continue
+                if best is None or (start, -length) < (best[0], -best[1]):
+                    best = (start, length, product_id)
+        return best[2] if best else None
+
+
+class ProductCatalog:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.products: Dict[str, dict] = {}
+        self.matcher = ProductMatcher({})
+        self.resolved: Dict[str, Tuple[str, str]] = {}
+        self.digest = ""
+        self._stamp: object = False
+
+    def load(self) -> bool:
+        try:
+            stat = os.stat(self.path)
+            stamp: object = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self._stamp:
+            return False
+        self.products = {}
+        if stamp is not None:
+            with open(self.path, "r", encoding="utf-8") as handle:
+                self.products = json.load(handle).get("products", {})
+        self._stamp = stamp
+        self.compile()
+        return True
+
+    def save(self) -> None:
+        catalog_dir = os.path.dirname(self.path)
+        if catalog_dir:
+            os.makedirs(catalog_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=catalog_dir or ".", suffix=".tmp", delete=False, encoding="utf-8"
+        ) as handle:
+            json.dump({"products": self.products}, handle, ensure_ascii=False, indent=2)
+            temp_path = handle.name
+        os.replace(temp_path, self.path)
+        self._stamp = False
+        self.load()
+
+    def compile(self) -> None:
+        patterns: Dict[str, str] = {}
+        for product_id, product in self.products.items():
+            for alias in [product_id, product.get("name", ""), *product.get("aliases", [])]:
+                pattern = normalize_product_key(alias)
+                if pattern:
+                    patterns.setdefault(pattern, product_id)
+        self.matcher = ProductMatcher(patterns)
+        self.resolved = {}
+        self.digest = hashlib.sha1(json.dumps(self.products, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def resolve(self, product_name: str) -> Tuple[str, str]:
+        key = normalize_product_key(product_name)
+        cached = self.resolved.get(key)
+        if cached is not None:
+            return cached
+        product_id = self.matcher.find(key)
+        if product_id:
+            cached = (f"#{product_id}", self.products[product_id].get("name") or product_id)
+        else:
+            cached = (key, format_product_name(product_name))
+        if len(self.resolved) >= 10000:
+            self.resolved.clear()
+        self.resolved[key] = cached
+        return cached
+
+
+PRODUCT_CATALOG = ProductCatalog(CATALOG_PATH)
+
+
+def order_product_quantities(order: Dict[str, str]) -> list[Tuple[str, str, float, str]]:
+    quantities = parse_quantity_list(order.get("quantita", ""))
+    products = parse_products_list(order.get("prodotti", ""), len(quantities))
+    if not products:
+        return []
+    quantity_given = bool(quantities)
+    if not quantities:
+        quantities = ["1"] * len(products)
+    elif len(quantities) == 1 and len(products) > 1:
+        quantities = quantities * len(products)
+    elif len(quantities) < len(products):
+        quantities = quantities + ["1"] * (len(products) - len(quantities))
+    elif len(quantities) != len(products) and len(products) == 1 and len(quantities) > 1:
+        quantities = [" ".join(quantities)]
+    items = []
+    for product, quantity in zip(products, quantities):
+        product_name = product.strip()
+        embedded = EMBEDDED_QUANTITY_REGEX.search(product_name)
+        if embedded and not quantity_given:
+            quantity = embedded.group(0)
+            product_name = EMBEDDED_QUANTITY_REGEX.sub("", product_name).strip()
+        if not product_name:
+            continue
+        amount, unit = parse_quantity_value(quantity)
+        if amount is None:
+            continue
+        key, name = PRODUCT_CATALOG.resolve(product_name)
+        amount, base_unit = normalize_unit(amount, unit)
+        items.append((key, name, amount, base_unit))
+    return items
+
+
+def format_amount(amount: float) -> str:
+    amount = round(amount, 6)
+    if amount.is_integer():
+        return str(int(amount))
+    return str(amount).rstrip("0").rstrip(".")
+
+
 def format_order(order: Dict[str, str]) -> str:
     lines = [f"🧾 Ordine #{order['id']}"]
     for field_key, label in ORDER_FIELDS.items():
@@ -548,6 +2267,22 @@ def format_order(order: Dict[str, str]) -> str:
     return "\n".join(lines)
 
 
+def format_order_line(order: Dict[str, str]) -> str:
+    username = order.get("username_telegram") or order.get("sender") or "-"
+    if username != "-" and not username.startswith("@"):
+        username = f"@{username}"
+    prodotti = order.get("prodotti", "-")
+    quantita = order.get("quantita", "-")
+    product_summary = prodotti if quantita == "-" else f"{prodotti} ({quantita})"
+    indirizzo = order.get("indirizzo", "-")
+    nome_cognome = order.get("nome_cognome", "-")
+    contatto = order.get("contatto", "-")
+    order_date = format_order_date(order)
+    ready_marker = " | ✅" if order.get("ready") else ""
+    details_line = " | ".join([indirizzo, nome_cognome, contatto, order_date])
+    return f"{order['id']}. {username} | {product_summary}\n{details_line}{ready_marker}"
+
+
 def build_orders_keyboard(order_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
@@ -578,6 +2313,60 @@ def build_edit_fields_keyboard(order_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
+def build_duplicate_keyboard(duplicate_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton("💾 Salva comunque", callback_data=f"dup_save:{duplicate_id}"),
+                InlineKeyboardButton("⏭️ Salta", callback_data=f"dup_skip:{duplicate_id}"),
+            ]
+        ]
+    )
+
+
+def customer_ref(customer_key: str) -> str:
+    return hashlib.sha1(customer_key.encode("utf-8")).hexdigest()[:10]
+
+
+def build_customer_keyboard(customer_key: str, page: int, total_pages: int) -> Optional[InlineKeyboardMarkup]:
+    ref = customer_ref(customer_key)
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"customer_page:{ref}:{page - 1}"))
+    if page < total_pages:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"customer_page:{ref}:{page + 1}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+def format_customer_page(store: OrderStore, customer_key: str, customer: dict, page: int) -> Tuple[str, int, int]:
+    entries = customer["entries"]
+    total_pages = max(1, -(-len(entries) // CUSTOMER_PAGE_SIZE))
+    page = min(max(page, 1), total_pages)
+    end = len(entries) - (page - 1) * CUSTOMER_PAGE_SIZE
+    start = max(0, end - CUSTOMER_PAGE_SIZE)
+    label = f"@{customer_key[2:]}" if customer_key.startswith("u:") else customer_key[2:]
+    last_order = store.get_order(entries[-1][1])
+    lines = [
+        f"👤 {label}",
+        f"Ordini: {len(entries)} | In sospeso: {customer['pending']} | "
+        f"Ultimo ordine: {format_order_date(last_order) if last_order else '-'}",
+    ]
+    products = sorted(customer["products"].items(), key=lambda item: item[1]["name"])
+    if products:
+        lines.append(
+            "Prodotti: "
+            + ", ".join(f"{product['name']} {format_quantity(product['amount'], unit)}" for (_, unit), product in products)
+        )
+    lines.append("")
+    for _, order_id in reversed(entries[start:end]):
+        order = store.get_order(order_id)
+        if order:
+            lines.append(store.render_order_line(order))
+    if total_pages > 1:
+        lines.append(f"\nPagina {page}/{total_pages}")
+    return "\n".join(lines), page, total_pages
+
+
 def build_missing_fields_keyboard(draft_id: int, missing_fields: list[str]) -> InlineKeyboardMarkup:
     rows = []
     for field_key in missing_fields:
@@ -591,66 +2380,66 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "Ciao! Inviami un messaggio con il form ordine compilato e lo salverò.\n\n"
         "Comandi disponibili:\n"
         "• /orders [query] [--ready|--pending] [--from YYYY-MM-DD] [--to YYYY-MM-DD]\n"
-        "• /order <id> - mostra un ordine specifico\n"
+        "  query: campo:valore, \"frase\", OR, NOT/-, ( ), status:pending, created:2024-01-01..2024-01-31,\n"
+        "  put:>=2024-02-01, id:10..20, customer:@utente, sort:-created, limit:20\n"
+        "• /order <id> [--raw] - mostra un ordine specifico o il testo originale\n"
         "• /search <termine> - cerca per username, prodotto o stato\n"
+        "• /customer <@username|contatto> [pagina] - storico ordini di un cliente\n"
         "• /totals - riepilogo quantità ordini non pronti\n"
+        "• /digest HH:MM [fuso orario] | off | now - riepilogo giornaliero programmato\n"
+        "• /catalog [add|alias|unalias|remove] - gestisce catalogo prodotti e alias (modifiche solo admin)\n"
         "• /delete_order <id> - elimina un ordine\n"
         "• /fields [termine] - elenco campi con suggerimenti\n"
-        "• /export [--ready|--pending] [--from YYYY-MM-DD] [--to YYYY-MM-DD] - esporta CSV\n"
-        "• /import - importa un CSV di backup esportato dal bot"
+        "• /export [--ready|--pending] [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--since <cursore>] - esporta CSV\n"
+        "• /import - importa un CSV di backup esportato dal bot\n"
+        "• /ingest - aggiunge ordini da un file .txt o .jsonl\n"
+        "• /dedupe - cerca possibili ordini duplicati\n"
+        "• /profile [N] [Ts] [--flame] - profila i prossimi update (solo admin)\n"
+        "• /stats [parser [on|off|reset]] - statistiche di memoria, cache e parser (solo admin)\n"
+        "• /backup, /restore [nome|latest] - backup e ripristino (solo admin)"
     )
     await update.message.reply_text(message)
 
 
 async def list_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = load_orders()
-    orders = data.get("orders", [])
-    query, ready_filter, from_date, to_date = extract_list_options(context.args)
-    orders = filter_orders(orders, query, ready_filter, from_date, to_date)
+    store = load_store(update)
+    try:
+        plan = compile_query(context.args or [])
+    except QueryError as error:
+        await update.message.reply_text(f"Query non valida: {error}")
+        return
+    orders = plan.run(store)
     if not orders:
         await update.message.reply_text("Nessun ordine salvato al momento.")
         return
-    lines = []
-    for order in orders:
-        username = order.get("username_telegram") or order.get("sender") or "-"
-        if username != "-" and not username.startswith("@"):
-            username = f"@{username}"
-        prodotti = order.get("prodotti", "-")
-        quantita = order.get("quantita", "-")
-        product_summary = prodotti if quantita == "-" else f"{prodotti} ({quantita})"
-        indirizzo = order.get("indirizzo", "-")
-        nome_cognome = order.get("nome_cognome", "-")
-        contatto = order.get("contatto", "-")
-        order_date = format_order_date(order)
-        ready_marker = " | ✅" if order.get("ready") else ""
-        details_line = " | ".join([indirizzo, nome_cognome, contatto, order_date])
-        lines.append(
-            f"{order['id']}. {username} | {product_summary}\n{details_line}{ready_marker}"
-        )
+    lines = [store.render_order_line(order) for order in orders]
     await update.message.reply_text("\n".join(lines), reply_markup=build_orders_list_keyboard())
 
 
 async def show_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not context.args:
-        await update.message.reply_text("Uso: /order <id>")
+        await update.message.reply_text("Uso: /order <id> [--raw]")
         return
-    order_id = context.args[0]
-    data = load_orders()
-    order = next((item for item in data.get("orders", []) if str(item["id"]) == order_id), None)
+    store = load_store(update)
+    order = store.get_order(context.args[0])
     if not order:
         await update.message.reply_text("Ordine non trovato.")
         return
-    await update.message.reply_text(format_order(order), reply_markup=build_orders_keyboard(order["id"]))
+    if "--raw" in context.args[1:]:
+        raw_text = store.raw_text(order)
+        await update.message.reply_text(raw_text or "Testo originale non disponibile.")
+        return
+    await update.message.reply_text(store.render_order(order), reply_markup=build_orders_keyboard(order["id"]))
 
 
 async def list_fields(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = load_orders()
+    snapshot = load_snapshot(update)
     query = " ".join(context.args).strip().lower() if context.args else None
     lines = []
     for key, label in ORDER_FIELDS.items():
         if query and query not in key.lower() and query not in label.lower():
             continue
-        suggestions = build_value_suggestions(key, data.get("orders", []))
+        suggestions = build_value_suggestions(key, snapshot.orders)
         suggestion_text = f" (es: {', '.join(suggestions)})" if suggestions else ""
         lines.append(f"{key}: {label}{suggestion_text}")
     if not lines:
@@ -659,53 +2448,32 @@ async def list_fields(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     await update.message.reply_text("Campi modificabili:\n" + "\n".join(lines))
 
 
-async def totals_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = load_orders()
-    orders = [order for order in data.get("orders", []) if not order.get("ready")]
-    if not orders:
-        await update.message.reply_text("Nessun ordine in sospeso.")
-        return
+def build_totals_lines(orders: Iterable[Dict[str, str]]) -> list[str]:
     totals: Dict[str, Dict[str, float]] = {}
     display_names: Dict[str, str] = {}
     for order in orders:
-        prodotti = order.get("prodotti", "")
-        quantita = order.get("quantita", "")
-        quantities = parse_quantity_list(quantita)
-        products = parse_products_list(prodotti, len(quantities))
-        if not products:
-            continue
-        if not quantities:
-            quantities = ["1"] * len(products)
-        elif len(quantities) == 1 and len(products) > 1:
-            quantities = quantities * len(products)
-        elif len(quantities) < len(products):
-            quantities = quantities + ["1"] * (len(products) - len(quantities))
-        elif len(quantities) != len(products) and len(products) == 1 and len(quantities) > 1:
-            quantities = [" ".join(quantities)]
-        for product, quantity in zip(products, quantities):
-            product_name = product.strip()
-            if not product_name:
-                continue
-            key = normalize_product_key(product_name)
-            display_names.setdefault(key, format_product_name(product_name))
-            amount, unit = parse_quantity_value(quantity)
-            if amount is None:
-                continue
+        for key, name, amount, unit in order_product_quantities(order):
+            display_names.setdefault(key, name)
             totals.setdefault(key, {})
             totals[key][unit] = totals[key].get(unit, 0.0) + amount
-    if not totals:
-        await update.message.reply_text("Nessun totale disponibile.")
-        return
     lines = []
     for key in sorted(totals, key=lambda item: display_names.get(item, item)):
         name = display_names.get(key, key)
         for unit, amount in totals[key].items():
-            if amount.is_integer():
-                amount_text = str(int(amount))
-            else:
-                amount_text = str(amount).rstrip("0").rstrip(".")
-            unit_text = f"{unit}" if unit else ""
-            lines.append(f"{name} {amount_text}{unit_text}".strip())
+            lines.append(f"{name} {format_quantity(amount, unit)}".strip())
+    return lines
+
+
+async def totals_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    snapshot = load_snapshot(update)
+    orders = [order for order in snapshot.orders if not order.get("ready")]
+    if not orders:
+        await update.message.reply_text("Nessun ordine in sospeso.")
+        return
+    lines = await asyncio.to_thread(build_totals_lines, orders)
+    if not lines:
+        await update.message.reply_text("Nessun totale disponibile.")
+        return
     await update.message.reply_text("\n".join(lines))
 
 
@@ -713,36 +2481,80 @@ async def delete_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if not context.args:
         await update.message.reply_text("Uso: /delete_order <id>")
         return
-    order_id = context.args[0]
-    data = load_orders()
-    orders = data.get("orders", [])
-    new_orders = [order for order in orders if str(order["id"]) != order_id]
-    if len(new_orders) == len(orders):
+    store = load_store(update)
+    async with store.lock:
+        deleted = store.delete_order(context.args[0])
+        if deleted:
+            store.save()
+    if not deleted:
         await update.message.reply_text("Ordine non trovato.")
         return
-    data["orders"] = new_orders
-    save_orders(data)
     await update.message.reply_text("✅ Ordine eliminato.")
 
 
-async def export_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = load_orders()
-    query, ready_filter, from_date, to_date = extract_list_options(context.args)
-    orders = filter_orders(data.get("orders", []), query, ready_filter, from_date, to_date)
-    if not orders:
-        await update.message.reply_text("Nessun ordine da esportare con questi filtri.")
-        return
-    headers = ["id", "created_at", "ready", "sender", *ORDER_FIELDS.keys(), "raw_text"]
+def write_orders_csv(
+    orders: Iterable[Dict[str, str]],
+    headers: list[str] = EXPORT_HEADERS,
+    tombstones: Iterable[Dict[str, object]] = (),
+    raw_text: Optional[Callable[[dict], str]] = None,
+) -> str:
     with tempfile.NamedTemporaryFile("w+", suffix=".csv", delete=False, encoding="utf-8") as handle:
         writer = csv.DictWriter(handle, fieldnames=headers)
         writer.writeheader()
         for order in orders:
             row = {key: order.get(key, "") for key in headers}
             row["ready"] = "yes" if order.get("ready") else "no"
+            if raw_text and "raw_text" in headers:
+                row["raw_text"] = raw_text(order)
+            if "deleted" in headers:
+                row["deleted"] = "no"
             writer.writerow(row)
-        temp_path = handle.name
+        for tombstone in tombstones:
+            writer.writerow({"id": tombstone["id"], "seq": tombstone["seq"], "deleted": "yes"})
+        return handle.name
+
+
+def pop_since_option(args: list[str]) -> Tuple[Optional[int], list[str]]:
+    remaining = list(args)
+    if "--since" not in remaining:
+        return None, remaining
+    index = remaining.index("--since")
+    value = remaining[index + 1] if index + 1 < len(remaining) else ""
+    del remaining[index : index + 2]
+    return (int(value) if value.isdigit() else -1), remaining
+
+
+async def export_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    since, args = pop_since_option(context.args or [])
+    if since is not None and since < 0:
+        await update.message.reply_text("Uso: /export --since <cursore> [filtri]")
+        return
+    try:
+        plan = compile_query(args)
+    except QueryError as error:
+        await update.message.reply_text(f"Query non valida: {error}")
+        return
+    store = load_store(update)
+    snapshot = store.snapshot()
+    tombstones: list[dict] = []
+    if since is None:
+        source, cursor = plan.select(store), store.cursor
+    else:
+        source, tombstones, cursor = store.changes_since(since)
+    orders = await asyncio.to_thread(plan.apply, source)
+    if since is not None and not orders and not tombstones:
+        await update.message.reply_text(f"Nessuna modifica dal cursore {since}. Cursore attuale: {cursor}")
+        return
+    if not orders and not tombstones:
+        await update.message.reply_text("Nessun ordine da esportare con questi filtri.")
+        return
+    headers = EXPORT_HEADERS if since is None else DELTA_EXPORT_HEADERS
+    temp_path = await asyncio.to_thread(write_orders_csv, orders, headers, tombstones, snapshot.raw_text)
+    filename = "orders_export.csv" if since is None else f"orders_delta_{since}_{cursor}.csv"
     try:
-        await update.message.reply_document(document=open(temp_path, "rb"), filename="orders_export.csv")
+        await update.message.reply_document(
+            document=open(temp_path, "rb"), filename=filename, caption=f"Cursore: {cursor}"
+        )
     finally:
         os.remove(temp_path)
 
@@ -754,6 +2566,100 @@ async def import_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     )
 
 
+async def dedupe_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    store = load_store(update)
+    snapshot = store.snapshot()
+    clusters = await asyncio.to_thread(find_duplicate_clusters, snapshot.orders, snapshot.raw_text_key)
+    if not clusters:
+        await update.message.reply_text("Nessun possibile duplicato trovato.")
+        return
+    lines = [f"Possibili duplicati ({len(clusters)} gruppi):"]
+    for ids, reasons in clusters:
+        lines.append("• " + ", ".join(f"#{order_id}" for order_id in ids) + f" ({', '.join(reasons)})")
+    await update.message.reply_text("\n".join(lines))
+
+
+async def manage_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    PRODUCT_CATALOG.load()
+    args = list(context.args or [])
+    usage = (
+        "Uso:\n"
+        "• /catalog - elenco prodotti\n"
+        "• /catalog add <id> <nome> - aggiunge un prodotto\n"
+        "• /catalog alias <id> <alias> - aggiunge un alias\n"
+        "• /catalog unalias <id> <alias> - rimuove un alias\n"
+        "• /catalog remove <id> - elimina un prodotto"
+    )
+    if not args:
+        if not PRODUCT_CATALOG.products:
+            await update.message.reply_text("Catalogo vuoto.\n\n" + usage)
+            return
+        lines = ["📦 Catalogo prodotti:"]
+        for product_id, product in sorted(PRODUCT_CATALOG.products.items()):
+            aliases = ", ".join(product.get("aliases", []))
+            lines.append(f"• {product_id}: {product.get('name', product_id)}" + (f" (alias: {aliases})" if aliases else ""))
+        await update.message.reply_text("\n".join(lines))
+        return
+    if not is_admin(update):
+        await update.message.reply_text("Comando riservato agli amministratori.")
+        return
+    action = args[0].lower()
+    product_id = normalize_product_key(args[1]).replace(" ", "-") if len(args) > 1 else ""
+    value = " ".join(args[2:]).strip()
+    products = PRODUCT_CATALOG.products
+    if action == "add" and product_id:
+        products[product_id] = {
+            "name": value or format_product_name(args[1]),
+            "aliases": products.get(product_id, {}).get("aliases", []),
+        }
+        reply = f"✅ Prodotto {product_id} salvato."
+    elif action == "alias" and product_id in products and value:
+        aliases = products[product_id].setdefault("aliases", [])
+        if normalize_product_key(value) not in (normalize_product_key(alias) for alias in aliases):
+            aliases.append(value)
+        reply = f"✅ Alias '{value}' aggiunto a {product_id}."
+    elif action == "unalias" and product_id in products and value:
+        aliases = products[product_id].get("aliases", [])
+        products[product_id]["aliases"] = [
+            alias for alias in aliases if normalize_product_key(alias) != normalize_product_key(value)
+        ]
+        reply = f"✅ Alias '{value}' rimosso da {product_id}."
+    elif action == "remove" and product_id in products:
+        del products[product_id]
+        reply = f"✅ Prodotto {product_id} eliminato."
+    elif action in ("alias", "unalias", "remove") and product_id and product_id not in products:
+        await update.message.reply_text(f"Prodotto '{product_id}' non presente nel catalogo.")
+        return
+    else:
+        await update.message.reply_text(usage)
+        return
+    PRODUCT_CATALOG.save()
+    for store in ORDER_SHARDS.stores.values():
+        store.rebuild_indexes()
+    await update.message.reply_text(reply)
+
+
+async def customer_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not context.args:
+        await update.message.reply_text("Uso: /customer <@username|contatto> [pagina]")
+        return
+    args = list(context.args)
+    page = 1
+    store = load_store(update)
+    found = store.find_customer(" ".join(args))
+    if not found and len(args) > 1 and args[-1].isdigit() and len(args[-1]) <= 3:
+        found = store.find_customer(" ".join(args[:-1]))
+        if found:
+            page = int(args[-1])
+    if not found:
+        await update.message.reply_text("Cliente non trovato.")
+        return
+    customer_key, customer = found
+    context.user_data.setdefault("customer_refs", {})[customer_ref(customer_key)] = customer_key
+    text, page, total_pages = format_customer_page(store, customer_key, customer, page)
+    await update.message.reply_text(text, reply_markup=build_customer_keyboard(customer_key, page, total_pages))
+
+
 async def search_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not context.args:
         await update.message.reply_text("Uso: /search <termine>")
@@ -761,7 +2667,204 @@ async def search_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await list_orders(update, context)
 
 
+def order_created_at(date_override: Optional[str]) -> str:
+    return f"{date_override} 00:00 UTC" if date_override else datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
+
+
+def build_order_fields(
+    block: str, parsed: Dict[str, str], date_override: Optional[str], sender: str
+) -> Dict[str, str]:
+    fields = {"created_at": order_created_at(date_override), "raw_text": block, "sender": sender}
+    fields.update(parsed)
+    if date_override:
+        fields["put_date"] = date_override
+    return fields
+
+
+def iter_ingest_file(path: str, file_name: str) -> Iterator[Tuple[str, Optional[Dict[str, str]], Optional[str]]]:
+    with open(path, "r", encoding="utf-8", errors="replace") as handle:
+        if file_name.lower().endswith(".jsonl"):
+            for line in handle:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    yield line.strip(), None, None
+                    continue
+                if isinstance(record, dict) and not (record.get("text") or record.get("raw_text")):
+                    parsed = {key: str(record[key]).strip() for key in ORDER_FIELDS if record.get(key)}
+                    put_date = str(record.get("put_date") or "")
+                    yield line.strip(), parsed or None, put_date if parse_date(put_date) else None
+                    continue
+                if not isinstance(record, (dict, str)):
+                    yield line.strip(), None, None
+                    continue
+                text = record if isinstance(record, str) else str(record.get("text") or record.get("raw_text"))
+                parsed_blocks = parse_message_blocks(text[:INGEST_MAX_BLOCK_CHARS])
+                if not parsed_blocks:
+                    yield text, None, None
+                yield from parsed_blocks
+            return
+        section = 0
+
+        def section_key(line: str) -> int:
+            nonlocal section
+            if ORDER_SEPARATOR_REGEX.match(line):
+                section += 1
+            return section
+
+        for _, lines in itertools.groupby(handle, key=section_key):
+            yield from iter_ingest_section(lines)
+
+
+def iter_ingest_section(lines: Iterable[str]) -> Iterator[Tuple[str, Optional[Dict[str, str]], Optional[str]]]:
+    form_lines: list[str] = []
+    form_size = 0
+
+    def remember(section_lines: Iterable[str]) -> Iterator[str]:
+        nonlocal form_size
+        for line in section_lines:
+            if ORDER_SEPARATOR_REGEX.match(line):
+                continue
+            if form_size < INGEST_MAX_BLOCK_CHARS:
+                form_lines.append(line)
+                form_size += len(line)
+            yield line
+
+    unparsed = 0
+    blocks = iter_numbered_blocks(remember(lines), INGEST_MAX_BLOCK_CHARS)
+    while chunk := list(itertools.islice(blocks, INGEST_BATCH_SIZE)):
+        results = parse_numbered_order_blocks(chunk)
+        if not any(parsed for parsed, _ in results):
+            unparsed += len(chunk)
+            continue
+        for _ in range(unparsed):
+            yield "", None, None
+        for block, (parsed, date_override) in zip(chunk, results):
+            yield block, parsed, date_override
+        while chunk := list(itertools.islice(blocks, INGEST_BATCH_SIZE)):
+            for block, (parsed, date_override) in zip(chunk, parse_numbered_order_blocks(chunk)):
+                yield block, parsed, date_override
+        return
+    text = "".join(form_lines).strip()
+    if text:
+        parsed, date_override = parse_order_message(text)
+        yield text, parsed, date_override
+
+
+def format_ingest_progress(counts: Dict[str, int], done: bool, failed: bool = False) -> str:
+    if failed:
+        title = "❌ Importazione interrotta per un errore"
+    else:
+        title = "✅ Importazione completata" if done else "⏳ Importazione in corso"
+    lines = [
+        f"{title}: {counts['blocks']} blocchi letti",
+        f"• salvati: {counts['saved']}",
+        f"• bozze incomplete: {counts['drafts']}",
+        f"• possibili duplicati saltati: {counts['duplicates']}",
+        f"• non riconosciuti: {counts['skipped']}",
+    ]
+    if counts["dropped_drafts"]:
+        lines.append(f"• incompleti oltre il limite di {INGEST_MAX_DRAFTS} bozze: {counts['dropped_drafts']}")
+    return "\n".join(lines)
+
+
+async def ingest_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data["awaiting_ingest"] = True
+    await update.message.reply_text(
+        "Invia un file .txt (form separati da --- o elenco numerato) oppure .jsonl da importare.\n"
+        "Gli ordini completi vengono aggiunti a quelli esistenti."
+    )
+
+
+async def ingest_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    document = update.message.document
+    file_name = (document.file_name or "").lower() if document else ""
+    if not file_name.endswith((".txt", ".jsonl")):
+        await update.message.reply_text("Il file deve essere .txt o .jsonl.")
+        return
+    sender = update.message.from_user.username or update.message.from_user.full_name
+    store = load_store(update)
+    draft_orders = context.user_data.setdefault("draft_orders", {})
+    draft_counter = context.user_data.get("draft_counter", 1)
+    counts = {"blocks": 0, "saved": 0, "drafts": 0, "duplicates": 0, "skipped": 0, "dropped_drafts": 0}
+    notices: list[Tuple[str, InlineKeyboardMarkup]] = []
+    temp_path = None
+    try:
+        file = await document.get_file()
+        with tempfile.NamedTemporaryFile("wb", suffix=os.path.splitext(file_name)[1], delete=False) as handle:
+            temp_path = handle.name
+        await file.download_to_drive(custom_path=temp_path)
+        progress = await update.message.reply_text(format_ingest_progress(counts, done=False))
+        last_progress = time.monotonic()
+        items = iter_ingest_file(temp_path, file_name)
+        failed = False
+        try:
+            while True:
+                batch = await asyncio.to_thread(list, itertools.islice(items, INGEST_BATCH_SIZE))
+                if not batch:
+                    break
+                async with store.lock:
+                    created = 0
+                    for block, parsed, date_override in batch:
+                        counts["blocks"] += 1
+                        if not parsed:
+                            counts["skipped"] += 1
+                            continue
+                        missing = get_missing_fields(parsed)
+                        if missing:
+                            if counts["drafts"] >= INGEST_MAX_DRAFTS:
+                                counts["dropped_drafts"] += 1
+                                continue
+                            draft_id = str(draft_counter)
+                            draft_counter += 1
+                            counts["drafts"] += 1
+                            draft_orders[draft_id] = {
+                                "parsed": parsed,
+                                "raw_text": block,
+                                "sender": sender,
+                                "created_at": order_created_at(date_override),
+                                "put_date": date_override,
+                            }
+                            notices.append(
+                                (
+                                    f"⚠️ Ordine incompleto: {block.splitlines()[0][:80]}\nMancano:\n"
+                                    + "\n".join(f"• {ORDER_FIELDS.get(key, key)}" for key in missing),
+                                    build_missing_fields_keyboard(int(draft_id), missing),
+                                )
+                            )
+                            continue
+                        fields = build_order_fields(block, parsed, date_override, sender)
+                        if store.find_duplicates(fields):
+                            counts["duplicates"] += 1
+                            continue
+                        store.create_order(fields)
+                        created += 1
+                    if created:
+                        store.save()
+                counts["saved"] += created
+                if time.monotonic() - last_progress >= INGEST_PROGRESS_INTERVAL:
+                    await progress.edit_text(format_ingest_progress(counts, done=False))
+                    last_progress = time.monotonic()
+        except Exception:
+            logger.exception("Importazione di %s interrotta", file_name)
+            failed = True
+        finally:
+            items.close()
+    finally:
+        context.user_data["draft_counter"] = draft_counter
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+    await progress.edit_text(format_ingest_progress(counts, done=True, failed=failed))
+    for notice, keyboard in notices:
+        await update.message.reply_text(notice, reply_markup=keyboard)
+
+
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if context.user_data.pop("awaiting_ingest", False):
+        await ingest_document(update, context)
+        return
     if not context.user_data.pop("awaiting_import", False):
         return
     document = update.message.document
@@ -780,7 +2883,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         with open(temp_path, "r", encoding="utf-8") as handle:
             reader = csv.DictReader(handle)
             headers = reader.fieldnames or []
-            required_headers = ["id", "created_at", "ready", "sender", *ORDER_FIELDS.keys(), "raw_text"]
+            required_headers = EXPORT_HEADERS
             missing_headers = [header for header in required_headers if header not in headers]
             if missing_headers:
                 await update.message.reply_text(
@@ -798,9 +2901,10 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if not imported_orders:
             await update.message.reply_text("Nessun ordine trovato nel CSV.")
             return
-        next_id = max(order["id"] for order in imported_orders) + 1
-        data = {"next_id": next_id, "orders": imported_orders}
-        save_orders(data)
+        store = load_store(update)
+        async with store.lock:
+            store.replace_orders(imported_orders)
+            store.save()
         await update.message.reply_text(
             f"✅ Import completato. Ordini caricati: {len(imported_orders)}."
         )
@@ -829,15 +2933,14 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     action, payload = query.data.split(":", 1)
     if action == "delete":
-        order_id = payload
-        data = load_orders()
-        orders = data.get("orders", [])
-        new_orders = [order for order in orders if str(order["id"]) != order_id]
-        if len(new_orders) == len(orders):
+        store = load_store(update)
+        async with store.lock:
+            deleted = store.delete_order(payload)
+            if deleted:
+                store.save()
+        if not deleted:
             await query.edit_message_text("Ordine non trovato.")
             return
-        data["orders"] = new_orders
-        save_orders(data)
         await query.edit_message_text("✅ Ordine eliminato.")
         return
     if action == "edit_prompt":
@@ -846,13 +2949,40 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if action == "edit_field":
         order_id, field_key = payload.split(":", 1)
         context.user_data["awaiting_edit"] = {"order_id": order_id, "field": field_key}
-        data = load_orders()
-        suggestions = build_value_suggestions(field_key, data.get("orders", []))
+        suggestions = build_value_suggestions(field_key, load_snapshot(update).orders)
         suggestion_text = f"\nSuggerimenti: {', '.join(suggestions)}" if suggestions else ""
         await query.message.reply_text(
             f"Inserisci il nuovo valore per {ORDER_FIELDS.get(field_key, field_key)}.{suggestion_text}"
         )
         return
+    if action in ("dup_save", "dup_skip"):
+        fields = context.user_data.get("pending_duplicates", {}).pop(payload, None)
+        if not fields:
+            await query.edit_message_text("Ordine già gestito o non più disponibile.")
+            return
+        if action == "dup_skip":
+            await query.edit_message_text("⏭️ Ordine duplicato scartato.")
+            return
+        store = load_store(update)
+        async with store.lock:
+            order = store.create_order(fields)
+            store.save()
+        await query.edit_message_text(
+            "✅ Ordine salvato!\n\n" + store.render_order(order),
+            reply_markup=build_orders_keyboard(order["id"]),
+        )
+        return
+    if action == "customer_page":
+        ref, _, page_text = payload.partition(":")
+        customer_key = context.user_data.get("customer_refs", {}).get(ref)
+        store = load_store(update)
+        customer = store.customers.get(customer_key) if customer_key and page_text.isdigit() else None
+        if not customer:
+            await query.edit_message_text("Cliente non trovato.")
+            return
+        text, page, total_pages = format_customer_page(store, customer_key, customer, int(page_text))
+        await query.edit_message_text(text, reply_markup=build_customer_keyboard(customer_key, page, total_pages))
+        return
     if action == "draft_field":
         draft_id, field_key = payload.split(":", 1)
         context.user_data["awaiting_draft"] = {"draft_id": draft_id, "field": field_key}
@@ -869,20 +2999,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await update.message.reply_text("Inserisci un numero ordine valido.")
             return
         order_ids = sorted(set(order_ids), key=order_ids.index)
-        data = load_orders()
-        orders = data.get("orders", [])
+        store = load_store(update)
         matched_ids = []
         missing_ids = []
-        lookup = {str(order["id"]): order for order in orders}
-        for order_id in order_ids:
-            order = lookup.get(order_id)
-            if not order:
-                missing_ids.append(order_id)
-                continue
-            order["ready"] = True
-            matched_ids.append(order_id)
+        async with store.lock:
+            for order_id in order_ids:
+                if not store.update_order(order_id, {"ready": True}):
+                    missing_ids.append(order_id)
+                    continue
+                matched_ids.append(order_id)
+            if matched_ids:
+                store.save()
         if matched_ids:
-            save_orders(data)
             if len(matched_ids) == 1:
                 await update.message.reply_text(f"✅ Ordine #{matched_ids[0]} segnato come pronto.")
             else:
@@ -899,8 +3027,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if not order_id.isdigit():
             await update.message.reply_text("Inserisci un numero ordine valido.")
             return
-        data = load_orders()
-        order = next((item for item in data.get("orders", []) if str(item["id"]) == order_id), None)
+        store = load_store(update)
+        order = store.get_order(order_id)
         if not order:
             await update.message.reply_text("Ordine non trovato.")
             return
@@ -908,7 +3036,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text(
             "✅ Ordine selezionato. Invia una riga per volta nel formato Campo: Valore.\n"
             "Scrivi 'fine' per terminare.\n\n"
-            + format_order(order),
+            + store.render_order(order),
             reply_markup=InlineKeyboardMarkup(
                 [[InlineKeyboardButton("🗑️ Elimina questo ordine", callback_data=f"delete:{order_id}")]]
             ),
@@ -925,12 +3053,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if not lines:
             await update.message.reply_text("Invia almeno una riga nel formato Campo: Valore.")
             return
-        data = load_orders()
-        order = next((item for item in data.get("orders", []) if str(item["id"]) == editing_order_id), None)
+        store = load_store(update)
+        order = store.get_order(editing_order_id)
         if not order:
             context.user_data.pop("editing_order_id", None)
             await update.message.reply_text("Ordine non trovato.")
             return
+        updates: Dict[str, str] = {}
         updated_fields = []
         for line in lines:
             if ":" not in line:
@@ -952,12 +3081,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     f"Valore mancante per '{raw_label}'."
                 )
                 continue
-            order[field_key] = value
+            updates[field_key] = value
             updated_fields.append(ORDER_FIELDS.get(field_key, field_key))
         if updated_fields:
-            save_orders(data)
+            async with store.lock:
+                order = store.update_order(editing_order_id, updates)
+                if order:
+                    store.save()
+            if not order:
+                context.user_data.pop("editing_order_id", None)
+                await update.message.reply_text("Ordine non trovato.")
+                return
             await update.message.reply_text(
-                "✅ Campi aggiornati: " + ", ".join(updated_fields) + "\n\n" + format_order(order)
+                "✅ Campi aggiornati: " + ", ".join(updated_fields) + "\n\n" + store.render_order(order)
             )
         return
     awaiting_edit = context.user_data.pop("awaiting_edit", None)
@@ -968,15 +3104,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if not value:
             await update.message.reply_text("Valore non valido.")
             return
-        data = load_orders()
-        orders = data.get("orders", [])
-        for order in orders:
-            if str(order["id"]) == str(order_id):
-                order[field_key] = value
-                save_orders(data)
-                await update.message.reply_text("✅ Ordine aggiornato.\n\n" + format_order(order))
-                return
-        await update.message.reply_text("Ordine non trovato.")
+        store = load_store(update)
+        async with store.lock:
+            order = store.update_order(order_id, {field_key: value})
+            if order:
+                store.save()
+        if not order:
+            await update.message.reply_text("Ordine non trovato.")
+            return
+        await update.message.reply_text("✅ Ordine aggiornato.\n\n" + store.render_order(order))
         return
     awaiting_draft = context.user_data.pop("awaiting_draft", None)
     if awaiting_draft:
@@ -995,79 +3131,85 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 reply_markup=build_missing_fields_keyboard(int(draft_id), missing),
             )
             return
-        data = load_orders()
-        order_id = data.get("next_id", 1)
+        store = load_store(update)
         created_at = draft.get("created_at") or datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
-        order = {
-            "id": order_id,
+        fields = {
             "created_at": created_at,
             "raw_text": draft["raw_text"],
             "sender": draft["sender"],
         }
-        order.update(draft["parsed"])
+        fields.update(draft["parsed"])
         if draft.get("put_date"):
-            order["put_date"] = draft["put_date"]
-        data.setdefault("orders", []).append(order)
-        data["next_id"] = order_id + 1
-        save_orders(data)
+            fields["put_date"] = draft["put_date"]
+        async with store.lock:
+            order = store.create_order(fields)
+            store.save()
         draft_orders.pop(draft_id, None)
         await update.message.reply_text(
-            "✅ Ordine salvato!\n\n" + format_order(order),
+            "✅ Ordine salvato!\n\n" + store.render_order(order),
             reply_markup=build_orders_keyboard(order["id"]),
         )
         return
-    parsed_blocks = parse_numbered_orders_message(text)
-    if not parsed_blocks:
-        blocks = split_order_blocks(text)
-        for block in blocks:
-            parsed, date_override = parse_order_message(block)
-            if parsed:
-                parsed_blocks.append((block, parsed, date_override))
+    parsed_blocks = parse_message_blocks(text)
     if not parsed_blocks:
         return
 
-    data = load_orders()
+    store = load_store(update)
     new_orders = []
+    notices: list[Tuple[str, InlineKeyboardMarkup]] = []
     draft_orders = context.user_data.setdefault("draft_orders", {})
     draft_counter = context.user_data.get("draft_counter", 1)
-    for block, parsed, date_override in parsed_blocks:
-        missing = get_missing_fields(parsed)
-        created_at = (
-            f"{date_override} 00:00 UTC" if date_override else datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
-        )
-        if missing:
-            draft_id = str(draft_counter)
-            draft_counter += 1
-            draft_orders[draft_id] = {
-                "parsed": parsed,
-                "raw_text": block,
-                "sender": update.message.from_user.username or update.message.from_user.full_name,
-                "created_at": created_at,
-                "put_date": date_override,
-            }
-            await update.message.reply_text(
-                "⚠️ Ordine incompleto. Mancano:\n"
-                + "\n".join(f"• {ORDER_FIELDS.get(key, key)}" for key in missing)
-                + "\n\n"
-                + build_template_message(),
-                reply_markup=build_missing_fields_keyboard(int(draft_id), missing),
+    pending_duplicates = context.user_data.setdefault("pending_duplicates", {})
+    duplicate_counter = context.user_data.get("duplicate_counter", 1)
+    async with store.lock:
+        for block, parsed, date_override in parsed_blocks:
+            missing = get_missing_fields(parsed)
+            created_at = order_created_at(date_override)
+            if missing:
+                draft_id = str(draft_counter)
+                draft_counter += 1
+                draft_orders[draft_id] = {
+                    "parsed": parsed,
+                    "raw_text": block,
+                    "sender": update.message.from_user.username or update.message.from_user.full_name,
+                    "created_at": created_at,
+                    "put_date": date_override,
+                }
+                notices.append(
+                    (
+                        "⚠️ Ordine incompleto. Mancano:\n"
+                        + "\n".join(f"• {ORDER_FIELDS.get(key, key)}" for key in missing)
+                        + "\n\n"
+                        + build_template_message(),
+                        build_missing_fields_keyboard(int(draft_id), missing),
+                    )
+                )
+                continue
+            fields = build_order_fields(
+                block, parsed, date_override, update.message.from_user.username or update.message.from_user.full_name
             )
-            continue
-        order_id = data.get("next_id", 1)
-        order = {
-            "id": order_id,
-            "created_at": created_at,
-            "raw_text": block,
-            "sender": update.message.from_user.username or update.message.from_user.full_name,
-        }
-        order.update(parsed)
-        if date_override:
-            order["put_date"] = date_override
-        data.setdefault("orders", []).append(order)
-        data["next_id"] = order_id + 1
-        new_orders.append(order)
+            duplicates = store.find_duplicates(fields)
+            if duplicates:
+                duplicate_id = str(duplicate_counter)
+                duplicate_counter += 1
+                pending_duplicates[duplicate_id] = fields
+                notices.append(
+                    (
+                        "⚠️ Possibile duplicato di: "
+                        + ", ".join(f"#{duplicate['id']}" for duplicate in duplicates)
+                        + "\n\n"
+                        + format_order({"id": "?", **fields}),
+                        build_duplicate_keyboard(int(duplicate_id)),
+                    )
+                )
+                continue
+            new_orders.append(store.create_order(fields))
+        if new_orders:
+            store.save()
     context.user_data["draft_counter"] = draft_counter
-    save_orders(data)
+    context.user_data["duplicate_counter"] = duplicate_counter
+    for notice, keyboard in notices:
+        await update.message.reply_text(notice, reply_markup=keyboard)
 
     if not new_orders:
         return
@@ -1075,20 +3217,624 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if len(new_orders) == 1:
         order = new_orders[0]
         await update.message.reply_text(
-            "✅ Ordine salvato!\n\n" + format_order(order),
+            "✅ Ordine salvato!\n\n" + store.render_order(order),
             reply_markup=build_orders_keyboard(order["id"]),
         )
         return
 
     message = "✅ Ordini salvati!\n\n" + "\n\n".join(
-        format_order(order) for order in new_orders
+        store.render_order(order) for order in new_orders
     )
     await update.message.reply_text(message)
 
 
-def main() -> None:
-    application = Application.builder().token(BOT_TOKEN).build()
+def is_admin(update: Update) -> bool:
+    user = update.effective_user
+    return bool(user and user.id in ADMIN_USER_IDS)
+
+
+class StackSampler(threading.Thread):
+    def __init__(self, target_thread_id: int, interval: float) -> None:
+        super().__init__(daemon=True)
+        self.target_thread_id = target_thread_id
+        self.interval = interval
+        self.stacks: Dict[str, int] = {}
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if names:
+                stack = ";".join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self) -> str:
+        self._stop_event.set()
+        self.join()
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.stacks.items()))
+
+
+class ProfileSession:
+    def __init__(self, chat_id: int, max_updates: Optional[int], max_seconds: Optional[float], flame: bool) -> None:
+        self.chat_id = chat_id
+        self.max_updates = max_updates
+        self.deadline = time.monotonic() + max_seconds if max_seconds else None
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL) if flame else None
+        self.updates = 0
+        self.in_flight = 0
+        self.started_at = time.monotonic()
+        self.finished = False
+        if self.sampler:
+            self.sampler.start()
+
+    def expired(self) -> bool:
+        if self.max_updates is not None and self.updates >= self.max_updates:
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def report(self) -> Tuple[bytes, Optional[bytes]]:
+        buffer = io.StringIO()
+        buffer.write(
+            f"Profilo: {self.updates} update in {time.monotonic() - self.started_at:.1f}s\n\n"
+        )
+        if self.updates:
+            stats = pstats.Stats(self.profiler, stream=buffer)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(60)
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(30)
+        collapsed = self.sampler.stop().encode("utf-8") if self.sampler else None
+        return buffer.getvalue().encode("utf-8"), collapsed
+
+
+class ProfilingApplication(Application):
+    profile_session: Optional[ProfileSession] = None
+
+    async def process_update(self, update: object) -> None:
+        session = self.profile_session
+        if session is None:
+            return await super().process_update(update)
+        if session.in_flight == 0:
+            session.profiler.enable()
+        session.in_flight += 1
+        try:
+            return await super().process_update(update)
+        finally:
+            session.in_flight -= 1
+            session.updates += 1
+            if session.in_flight == 0:
+                session.profiler.disable()
+            if session.expired():
+                await self.finish_profile()
+
+    async def finish_profile(self) -> None:
+        session = self.profile_session
+        if session is None or session.finished or session.in_flight:
+            return
+        session.finished = True
+        self.profile_session = None
+        stats_text, collapsed = await asyncio.to_thread(session.report)
+        await self.bot.send_document(
+            session.chat_id, document=io.BytesIO(stats_text), filename="profile_stats.txt"
+        )
+        if collapsed is not None:
+            await self.bot.send_document(
+                session.chat_id, document=io.BytesIO(collapsed), filename="profile_stacks.collapsed"
+            )
+
+    async def _profile_deadline(self, session: ProfileSession, seconds: float) -> None:
+        await asyncio.sleep(seconds)
+        if self.profile_session is session:
+            await self.finish_profile()
+
+
+async def profile_updates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update):
+        await update.message.reply_text("Comando riservato agli amministratori.")
+        return
+    application = context.application
+    if not isinstance(application, ProfilingApplication):
+        await update.message.reply_text("Profilazione non disponibile.")
+        return
+    args = list(context.args or [])
+    if args and args[0] == "stop":
+        if application.profile_session is None:
+            await update.message.reply_text("Nessuna profilazione attiva.")
+            return
+        await application.finish_profile()
+        return
+    if application.profile_session is not None:
+        await update.message.reply_text("Profilazione già attiva. Usa /profile stop per terminarla.")
+        return
+    flame = "--flame" in args
+    args = [arg for arg in args if arg != "--flame"]
+    max_updates: Optional[int] = None
+    max_seconds: Optional[float] = None
+    for arg in args:
+        if re.fullmatch(r"\d+s", arg):
+            max_seconds = float(arg[:-1])
+        elif arg.isdigit():
+            max_updates = int(arg)
+        else:
+            await update.message.reply_text("Uso: /profile [N update] [Ts] [--flame] | /profile stop")
+            return
+    if max_updates is None and max_seconds is None:
+        max_updates = 50
+    session = ProfileSession(update.effective_chat.id, max_updates, max_seconds, flame)
+    application.profile_session = session
+    if max_seconds:
+        application.create_task(application._profile_deadline(session, max_seconds))
+    limits = []
+    if max_updates is not None:
+        limits.append(f"{max_updates} update")
+    if max_seconds is not None:
+        limits.append(f"{int(max_seconds)}s")
+    await update.message.reply_text(f"⏱️ Profilazione attiva per {' o '.join(limits)}.")
+
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update):
+        await update.message.reply_text("Comando riservato agli amministratori.")
+        return
+    args = [arg.lower() for arg in context.args or []]
+    if args and args[0] == "parser":
+        action = args[1] if len(args) > 1 else ""
+        if action in ("on", "off"):
+            PARSER_METRICS.enabled = action == "on"
+            await update.message.reply_text(
+                "✅ Metriche parser attivate." if PARSER_METRICS.enabled else "✅ Metriche parser disattivate."
+            )
+            return
+        if action == "reset":
+            PARSER_METRICS.reset()
+            await update.message.reply_text("✅ Metriche parser azzerate.")
+            return
+        await update.message.reply_text("\n".join(PARSER_METRICS.report_lines())[:4000])
+        return
+    store = load_store(update)
+    lines = [
+        "📊 Statistiche",
+        f"Shard in memoria: {len(ORDER_SHARDS.stores)}/{ORDER_SHARDS.max_loaded}",
+        f"Ordini in questo shard: {len(store.orders)} (cursore {store.cursor})",
+        f"Byte scritti: {ORDER_SHARDS.bytes_written}",
+        f"Change feed: {CHANGE_FEED.published} pubblicati, {CHANGE_FEED.delivered} consegnati, "
+        f"{CHANGE_FEED.dropped} scartati",
+        f"Render cache: {len(RENDER_CACHE.entries)}/{RENDER_CACHE.max_size} voci, "
+        f"{RENDER_CACHE.hits} hit, {RENDER_CACHE.misses} miss, hit rate {RENDER_CACHE.hit_rate:.1%}",
+        PARSER_METRICS.summary(),
+    ]
+    await update.message.reply_text("\n".join(lines))
+
+
+def list_shard_keys() -> list[str]:
+    keys = [DEFAULT_SHARD] if os.path.exists(DATA_PATH) else []
+    if os.path.isdir(SHARDS_DIR):
+        keys.extend(sorted(name[:-5] for name in os.listdir(SHARDS_DIR) if name.endswith(".json")))
+    return keys
+
+
+def backup_dir(shard_key: str) -> str:
+    return os.path.join(BACKUP_DIR, canonical_shard_key(shard_key))
+
+
+def load_backup_manifest(shard_key: str) -> dict:
+    path = os.path.join(backup_dir(shard_key), "manifest.json")
+    if not os.path.exists(path):
+        return {"snapshots": []}
+    with open(path, "r", encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def save_backup_manifest(shard_key: str, manifest: dict) -> None:
+    directory = backup_dir(shard_key)
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False, encoding="utf-8") as handle:
+        json.dump(manifest, handle, ensure_ascii=False, indent=2)
+        temp_path = handle.name
+    os.replace(temp_path, os.path.join(directory, "manifest.json"))
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_backup_file(path: str, header: dict, records: Iterable[dict]) -> Tuple[str, int]:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with gzip.open(temp_path, "wt", encoding="utf-8", compresslevel=6) as handle:
+        handle.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for record in records:
+            handle.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(temp_path, path)
+    return file_sha256(path), os.path.getsize(path)
+
+
+def build_backup_records(snapshot: OrderSnapshot, orders: Iterable[dict], tombstones: list[dict]) -> Iterator[dict]:
+    for order in orders:
+        yield {"order": snapshot.export_order(order)}
+    for tombstone in tombstones:
+        yield {"tombstone": tombstone}
+
+
+def iter_backup_records(path: str) -> Iterable[dict]:
+    with gzip.open(path, "rt", encoding="utf-8") as handle:
+        for line in handle:
+            if line.strip():
+                yield json.loads(line)
+
+
+def select_backups_to_keep(snapshots: list[dict]) -> set:
+    ordered = sorted(snapshots, key=lambda snapshot: snapshot["created_at"], reverse=True)
+    keep = {snapshot["name"] for snapshot in ordered[:BACKUP_KEEP_HOURLY]}
+    days: set = set()
+    weeks: set = set()
+    for snapshot in ordered:
+        created = datetime.strptime(snapshot["created_at"], "%Y-%m-%dT%H:%M:%SZ")
+        week = created.isocalendar()[:2]
+        if created.date() not in days and len(days) < BACKUP_KEEP_DAILY:
+            days.add(created.date())
+            keep.add(snapshot["name"])
+        if week not in weeks and len(weeks) < BACKUP_KEEP_WEEKLY:
+            weeks.add(week)
+            keep.add(snapshot["name"])
+    by_name = {snapshot["name"]: snapshot for snapshot in snapshots}
+    for name in list(keep):
+        base = by_name[name].get("base")
+        while base and base in by_name and base not in keep:
+            keep.add(base)
+            base = by_name[base].get("base")
+    return keep
+
+
+def rotate_backups(shard_key: str, manifest: dict) -> None:
+    keep = select_backups_to_keep(manifest["snapshots"])
+    for snapshot in manifest["snapshots"]:
+        if snapshot["name"] not in keep:
+            path = os.path.join(backup_dir(shard_key), snapshot["name"])
+            if os.path.exists(path):
+                os.remove(path)
+    manifest["snapshots"] = [snapshot for snapshot in manifest["snapshots"] if snapshot["name"] in keep]
+
+
+async def create_backup(shard_key: str, force: bool = False) -> Optional[dict]:
+    manifest = load_backup_manifest(shard_key)
+    snapshots = manifest["snapshots"]
+    last = snapshots[-1] if snapshots else None
+    path = shard_path(shard_key)
+    stat = os.stat(path) if os.path.exists(path) else None
+    file_stamp = [stat.st_mtime_ns, stat.st_size] if stat else None
+    if last and not force and last.get("file_stamp") == file_stamp:
+        return None
+    store = ORDER_SHARDS.get(shard_key)
+    deltas_since_full = 0
+    for snapshot in reversed(snapshots):
+        if snapshot["type"] == "full":
+            break
+        deltas_since_full += 1
+    incremental = (
+        last is not None
+        and store.cursor >= last["cursor"]
+        and deltas_since_full < BACKUP_FULL_EVERY
+        and os.path.exists(os.path.join(backup_dir(shard_key), last["name"]))
+    )
+    if incremental and store.cursor == last["cursor"] and not force:
+        last["file_stamp"] = file_stamp
+        save_backup_manifest(shard_key, manifest)
+        return None
+    created_at = datetime.utcnow()
+    header = {
+        "type": "delta" if incremental else "full",
+        "shard": shard_key,
+        "cursor": store.cursor,
+        "next_id": store.data.get("next_id", 1),
+        "created_at": created_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+    }
+    snapshot = store.snapshot()
+    tombstones: list[dict] = []
+    if incremental:
+        orders, tombstones, _ = store.changes_since(last["cursor"])
+        header["base"] = last["name"]
+        header["since"] = last["cursor"]
+    else:
+        orders = snapshot.orders
+    records = build_backup_records(snapshot, orders, tombstones)
+    name = f"{created_at.strftime('%Y%m%dT%H%M%S%fZ')}-{header['type']}.jsonl.gz"
+    sha256, size = await asyncio.to_thread(
+        write_backup_file, os.path.join(backup_dir(shard_key), name), header, records
+    )
+    record_count = len(orders) + len(tombstones)
+    entry = {
+        "name": name,
+        "type": header["type"],
+        "base": header.get("base"),
+        "cursor": header["cursor"],
+        "records": record_count,
+        "created_at": header["created_at"],
+        "sha256": sha256,
+        "size": size,
+        "file_stamp": file_stamp,
+    }
+    snapshots.append(entry)
+    rotate_backups(shard_key, manifest)
+    save_backup_manifest(shard_key, manifest)
+    logger.info("Backup %s (%s) creato per lo shard %s: %s record", name, header["type"], shard_key, record_count)
+    return entry
+
+
+def load_backup_state(shard_key: str, name: str) -> Tuple[list[dict], int]:
+    manifest = load_backup_manifest(shard_key)
+    by_name = {snapshot["name"]: snapshot for snapshot in manifest["snapshots"]}
+    chain = []
+    current: Optional[str] = name
+    while current:
+        if current not in by_name:
+            raise ValueError(f"snapshot {current} mancante")
+        chain.append(by_name[current])
+        current = by_name[current].get("base")
+    orders: Dict[int, dict] = {}
+    next_id = 1
+    for snapshot in reversed(chain):
+        path = os.path.join(backup_dir(shard_key), snapshot["name"])
+        if file_sha256(path) != snapshot["sha256"]:
+            raise ValueError(f"checksum non valido per {snapshot['name']}")
+        records = iter_backup_records(path)
+        header = next(records)
+        next_id = header.get("next_id", next_id)
+        for record in records:
+            if "order" in record:
+                orders[record["order"]["id"]] = record["order"]
+            elif "tombstone" in record:
+                orders.pop(record["tombstone"]["id"], None)
+    return list(orders.values()), next_id
+
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    for shard_key in list_shard_keys():
+        try:
+            await create_backup(shard_key)
+        except Exception:
+            logger.exception("Backup fallito per lo shard %s", shard_key)
+
+
+async def backup_now(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update):
+        await update.message.reply_text("Comando riservato agli amministratori.")
+        return
+    shard_key = shard_key_for(update)
+    load_store(update)
+    entry = await create_backup(shard_key, force=True)
+    await update.message.reply_text(
+        f"✅ Backup {entry['name']} creato ({entry['records']} record, {entry['size']} byte)."
+    )
+
+
+async def restore_backup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update):
+        await update.message.reply_text("Comando riservato agli amministratori.")
+        return
+    shard_key = shard_key_for(update)
+    snapshots = load_backup_manifest(shard_key)["snapshots"]
+    if not context.args:
+        if not snapshots:
+            await update.message.reply_text("Nessun backup disponibile.")
+            return
+        lines = ["Backup disponibili (usa /restore <nome>):"]
+        for snapshot in snapshots[-15:][::-1]:
+            lines.append(f"• {snapshot['name']} ({snapshot['type']}, cursore {snapshot['cursor']})")
+        await update.message.reply_text("\n".join(lines))
+        return
+    name = context.args[0]
+    if name == "latest" and snapshots:
+        name = snapshots[-1]["name"]
+    try:
+        orders, next_id = await asyncio.to_thread(load_backup_state, shard_key, name)
+    except (OSError, ValueError) as error:
+        await update.message.reply_text(f"Ripristino non riuscito: {error}")
+        return
+    store = load_store(update)
+    async with store.lock:
+        store.replace_orders(orders, next_id=next_id, event="restored")
+        store.save()
+    await update.message.reply_text(f"✅ Ripristinato {name}. Ordini caricati: {len(orders)}.")
+
 
+DIGEST_AGE_BUCKETS = ((0, "oggi"), (2, "1-2 giorni"), (7, "3-7 giorni"), (None, "oltre 7 giorni"))
+
+
+def load_digest_config() -> Dict[str, dict]:
+    if not os.path.exists(DIGEST_CONFIG_PATH):
+        return {}
+    with open(DIGEST_CONFIG_PATH, "r", encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def save_digest_config(config: Dict[str, dict]) -> None:
+    config_dir = os.path.dirname(DIGEST_CONFIG_PATH)
+    if config_dir:
+        os.makedirs(config_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=config_dir or ".", suffix=".tmp", delete=False, encoding="utf-8"
+    ) as handle:
+        json.dump(config, handle, ensure_ascii=False, indent=2)
+        temp_path = handle.name
+    os.replace(temp_path, DIGEST_CONFIG_PATH)
+
+
+def format_digest(store: OrderStore, since_id: int, today: date) -> str:
+    buckets = {label: 0 for _, label in DIGEST_AGE_BUCKETS}
+    undated = 0
+    future = 0
+    for day, count in store.pending_by_day.items():
+        try:
+            age = (today - date.fromisoformat(day)).days
+        except ValueError:
+            undated += count
+            continue
+        if age < 0:
+            future += count
+            continue
+        for limit, label in DIGEST_AGE_BUCKETS:
+            if limit is None or age <= limit:
+                buckets[label] += count
+                break
+    pending = sum(buckets.values()) + undated + future
+    lines = [
+        f"📋 Riepilogo del {today.strftime('%d/%m/%Y')}",
+        f"🆕 Nuovi ordini dall'ultimo riepilogo: {store.count_created_since(since_id)}",
+        f"⏳ Ordini in sospeso: {pending}",
+    ]
+    lines.extend(f"• {label}: {count}" for label, count in buckets.items() if count)
+    if future:
+        lines.append(f"• con data futura: {future}")
+    if undated:
+        lines.append(f"• senza data: {undated}")
+    totals = sorted(
+        (product["name"], unit, product["amount"]) for (_, unit), product in store.pending_products.items()
+    )
+    if totals:
+        lines.append("")
+        lines.append("📦 Da preparare:")
+        lines.extend(f"{name} {format_quantity(amount, unit)}".strip() for name, unit, amount in totals)
+    return "\n".join(lines)
+
+
+def schedule_digest(job_queue, chat_id: str, entry: dict) -> None:
+    for job in job_queue.get_jobs_by_name(f"digest:{chat_id}"):
+        job.schedule_removal()
+    hour, minute = (int(part) for part in entry["time"].split(":"))
+    job_queue.run_daily(
+        send_digest,
+        time=dtime(hour, minute, tzinfo=ZoneInfo(entry["tz"])),
+        chat_id=int(chat_id),
+        name=f"digest:{chat_id}",
+    )
+
+
+def schedule_digests(job_queue) -> None:
+    for chat_id, entry in load_digest_config().items():
+        try:
+            schedule_digest(job_queue, chat_id, entry)
+        except (ValueError, ZoneInfoNotFoundError):
+            logger.warning("Riepilogo non valido per la chat %s: %s", chat_id, entry)
+
+
+async def deliver_digest(bot, chat_id: str) -> None:
+    config = load_digest_config()
+    entry = config.get(chat_id)
+    if entry is None:
+        return
+    store = ORDER_SHARDS.get(entry["shard"])
+    today = datetime.now(ZoneInfo(entry["tz"])).date()
+    await bot.send_message(chat_id=int(chat_id), text=format_digest(store, entry.get("since_id", 1), today))
+    entry["since_id"] = store.data.get("next_id", 1)
+    entry["last_sent"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
+    save_digest_config(config)
+
+
+async def send_digest(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await deliver_digest(context.bot, str(context.job.chat_id))
+
+
+async def manage_digest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = str(update.effective_chat.id)
+    config = load_digest_config()
+    args = list(context.args or [])
+    usage = "Uso: /digest HH:MM [fuso orario] | /digest off | /digest now"
+    if not args:
+        entry = config.get(chat_id)
+        if entry:
+            await update.message.reply_text(f"Riepilogo giornaliero alle {entry['time']} ({entry['tz']}).\n{usage}")
+        else:
+            await update.message.reply_text(f"Nessun riepilogo programmato.\n{usage}")
+        return
+    if args[0].lower() == "now":
+        if chat_id not in config:
+            await update.message.reply_text("Prima programma il riepilogo con /digest HH:MM.")
+            return
+        await deliver_digest(context.bot, chat_id)
+        return
+    job_queue = context.application.job_queue
+    if args[0].lower() == "off":
+        config.pop(chat_id, None)
+        save_digest_config(config)
+        if job_queue is not None:
+            for job in job_queue.get_jobs_by_name(f"digest:{chat_id}"):
+                job.schedule_removal()
+        await update.message.reply_text("✅ Riepilogo giornaliero disattivato.")
+        return
+    match = re.fullmatch(r"([01]?\d|2[0-3]):([0-5]\d)", args[0])
+    timezone_name = args[1] if len(args) > 1 else DIGEST_TIMEZONE
+    if not match:
+        await update.message.reply_text(usage)
+        return
+    try:
+        ZoneInfo(timezone_name)
+    except (ValueError, ZoneInfoNotFoundError):
+        await update.message.reply_text(f"Fuso orario non valido: {timezone_name}")
+        return
+    if job_queue is None:
+        await update.message.reply_text("JobQueue non disponibile: impossibile programmare il riepilogo.")
+        return
+    store = load_store(update)
+    previous = config.get(chat_id, {})
+    entry = {
+        "time": f"{int(match.group(1)):02d}:{match.group(2)}",
+        "tz": timezone_name,
+        "shard": shard_key_for(update),
+        "since_id": previous.get("since_id", store.data.get("next_id", 1)),
+    }
+    config[chat_id] = entry
+    save_digest_config(config)
+    schedule_digest(job_queue, chat_id, entry)
+    await update.message.reply_text(f"✅ Riepilogo giornaliero alle {entry['time']} ({timezone_name}).")
+
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    with open(RECORD_UPDATES_PATH, "a", encoding="utf-8") as handle:
+        handle.write(update.to_json() + "\n")
+
+
+async def on_startup(application: Application) -> None:
+    started = time.perf_counter()
+    stores = await asyncio.to_thread(ORDER_SHARDS.warm_up)
+    logger.info(
+        "Store pronti in %.3fs: %s shard, %s ordini",
+        time.perf_counter() - started,
+        len(stores),
+        sum(len(store.orders) for store in stores),
+    )
+    await CHANGE_FEED.start()
+
+
+async def on_shutdown(application: Application) -> None:
+    await CHANGE_FEED.stop()
+    if ORDER_SHARDS.retiring:
+        await asyncio.gather(*ORDER_SHARDS.retiring, return_exceptions=True)
+    await asyncio.to_thread(ORDER_SHARDS.write_snapshots)
+
+
+def build_application(builder: ApplicationBuilder) -> Application:
+    builder.post_init(on_startup).post_shutdown(on_shutdown)
+    application = builder.application_class(ProfilingApplication).build()
+
+    if BACKUP_INTERVAL > 0:
+        if application.job_queue is None:
+            logger.warning("JobQueue non disponibile: backup automatici disattivati")
+        else:
+            application.job_queue.run_repeating(backup_job, interval=BACKUP_INTERVAL, first=BACKUP_INTERVAL)
+    if application.job_queue is not None:
+        schedule_digests(application.job_queue)
+
+    if RECORD_UPDATES_PATH:
+        application.add_handler(TypeHandler(Update, record_update), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("orders", list_orders))
     application.add_handler(CommandHandler("order", show_order))
@@ -1097,13 +3843,157 @@ def main() -> None:
     application.add_handler(CommandHandler("delete_order", delete_order))
     application.add_handler(CommandHandler("export", export_orders))
     application.add_handler(CommandHandler("import", import_orders))
+    application.add_handler(CommandHandler("ingest", ingest_orders))
     application.add_handler(CommandHandler("search", search_orders))
+    application.add_handler(CommandHandler("dedupe", dedupe_orders))
+    application.add_handler(CommandHandler("customer", customer_orders))
+    application.add_handler(CommandHandler("catalog", manage_catalog))
+    application.add_handler(CommandHandler("digest", manage_digest))
+    application.add_handler(CommandHandler("profile", profile_updates))
+    application.add_handler(CommandHandler("stats", show_stats))
+    application.add_handler(CommandHandler("backup", backup_now))
+    application.add_handler(CommandHandler("restore", restore_backup))
     application.add_handler(CallbackQueryHandler(handle_callback))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    return application
+
+
+def pop_cli_option(args: list[str], name: str) -> Tuple[Optional[str], list[str]]:
+    remaining = list(args)
+    if name not in remaining:
+        return None, remaining
+    index = remaining.index(name)
+    value = remaining[index + 1] if index + 1 < len(remaining) else ""
+    del remaining[index : index + 2]
+    return value, remaining
 
+
+def cli_query(store: OrderStore, args: argparse.Namespace) -> int:
+    orders = compile_query(args.filters).run(store)
+    for order in orders:
+        print(store.render_order_line(order))
+    print(f"{len(orders)} ordini", file=sys.stderr)
+    return 0
+
+
+def cli_export(store: OrderStore, args: argparse.Namespace) -> int:
+    output, filters = pop_cli_option(args.filters, "--output")
+    since, filters = pop_since_option(filters)
+    if since is not None and since < 0 or output == "":
+        print("Uso: export [--output FILE] [--since <cursore>] [filtri]", file=sys.stderr)
+        return 2
+    output = output or "orders_export.csv"
+    plan = compile_query(filters)
+    tombstones: list[dict] = []
+    if since is None:
+        source, cursor = plan.select(store), store.cursor
+    else:
+        source, tombstones, cursor = store.changes_since(since)
+    orders = plan.apply(source)
+    headers = EXPORT_HEADERS if since is None else DELTA_EXPORT_HEADERS
+    temp_path = write_orders_csv(orders, headers, tombstones, store.raw_text)
+    shutil.move(temp_path, output)
+    print(f"{len(orders)} ordini esportati in {output}. Cursore: {cursor}", file=sys.stderr)
+    return 0
+
+
+def cli_totals(store: OrderStore, args: argparse.Namespace) -> int:
+    lines = build_totals_lines(order for order in store.snapshot().orders if not order.get("ready"))
+    print("\n".join(lines) if lines else "Nessun ordine in sospeso.")
+    return 0
+
+
+def cli_ready(store: OrderStore, args: argparse.Namespace) -> int:
+    targets = [target for target in args.filters if target != "--undo"]
+    if not targets:
+        print("Indica gli id oppure dei filtri (es. --from 2024-01-01 --to 2024-01-31).", file=sys.stderr)
+        return 2
+    with store.locked():
+        if all(target.isdigit() for target in targets):
+            orders = [store.get_order(target) for target in targets]
+            missing = [target for target, order in zip(targets, orders) if order is None]
+            if missing:
+                print(f"Ordini non trovati: {', '.join(missing)}", file=sys.stderr)
+            orders = [order for order in orders if order is not None]
+        else:
+            orders = compile_query(targets).run(store)
+        ready = "--undo" not in args.filters
+        changed = [order["id"] for order in orders if bool(order.get("ready")) != ready]
+        for order_id in changed:
+            store.update_order(order_id, {"ready": ready})
+        if changed:
+            store.save()
+    print(f"{len(changed)} ordini aggiornati.", file=sys.stderr)
+    return 0
+
+
+def cli_migrate(store: OrderStore, args: argparse.Namespace) -> int:
+    with store.locked():
+        store.rebuild_indexes()
+        store.save()
+        store.write_binary_snapshot()
+    print(f"Shard {store.shard_key} migrato: {len(store.orders)} ordini, cursore {store.cursor}.", file=sys.stderr)
+    return 0
+
+
+CLI_COMMANDS = {
+    "query": cli_query,
+    "export": cli_export,
+    "totals": cli_totals,
+    "ready": cli_ready,
+    "migrate": cli_migrate,
+}
+
+
+def build_cli_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="telegram_bot.py",
+        description="Gestione ordini da riga di comando (senza argomenti avvia il bot).",
+        epilog=(
+            "comandi:\n"
+            "  query [filtri]                               elenca gli ordini filtrati\n"
+            "  export [--output FILE] [--since N] [filtri]  esporta gli ordini in CSV\n"
+            "  totals                                       totali prodotti degli ordini non pronti\n"
+            "  ready [--undo] <id...|filtri>                segna ordini come pronti\n"
+            "  migrate                                      riscrive lo shard nel formato corrente\n\n"
+            "filtri: query come in /orders, es. status:pending created:2024-01-01..2024-01-31 "
+            "prodotti:pane OR \"mario rossi\" -note:urgente sort:-created limit:50"
+        ),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--shard", default=DEFAULT_SHARD, help="shard da usare (default: %(default)s)")
+    parser.add_argument("command", choices=sorted(CLI_COMMANDS))
+    parser.add_argument("filters", nargs=argparse.REMAINDER)
+    return parser
+
+
+async def run_cli(args: argparse.Namespace) -> int:
+    CHANGE_FEED.synchronous = True
+    try:
+        return CLI_COMMANDS[args.command](ORDER_SHARDS.get(args.shard), args)
+    except QueryError as error:
+        print(f"Query non valida: {error}", file=sys.stderr)
+        return 2
+    finally:
+        CHANGE_FEED.synchronous = False
+
+
+def cli(argv: list[str]) -> int:
+    return asyncio.run(run_cli(build_cli_parser().parse_args(argv)))
+
+
+def main() -> None:
+    if not BOT_TOKEN:
+        raise ValueError("❌ BOT_TOKEN non trovato!")
+    builder = Application.builder().token(BOT_TOKEN)
+    if CONCURRENT_UPDATES:
+        builder.concurrent_updates(CONCURRENT_UPDATES)
+    application = build_application(builder)
     application.run_polling()
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(cli(sys.argv[1:]))
     main()
@@ -0,0 +1,76 @@
+import random
+import unittest
+from typing import Iterator
+
+from bench_dates import TEXT_CONTEXTS, strptime_text, strptime_token
+from telegram_bot import parse_date_from_text, parse_date_token, parse_dates_from_texts
+
+FOUR_DIGIT_YEARS = (
+    "0000", "0001", "0999", "1000", "1899", "1900", "1968", "1969", "1996", "1999",
+    "2000", "2023", "2024", "2068", "2069", "2099", "2100", "9999",
+)
+THREE_DIGIT_YEARS = ("000", "024", "199", "999")
+
+
+def iter_day_month_tokens() -> Iterator[str]:
+    for day in range(33):
+        for month in range(14):
+            for first in "/-":
+                for second in "/-":
+                    prefix = f"{day:02d}{first}{month:02d}{second}"
+                    for year in range(100):
+                        yield f"{prefix}{year:02d}"
+                    for year in THREE_DIGIT_YEARS + FOUR_DIGIT_YEARS:
+                        yield prefix + year
+
+
+def iter_iso_tokens() -> Iterator[str]:
+    for year in FOUR_DIGIT_YEARS:
+        for month in range(14):
+            for day in range(33):
+                yield f"{year}-{month:02d}-{day:02d}"
+
+
+class DateTokenEquivalenceTest(unittest.TestCase):
+    def assert_matches_strptime(self, tokens: Iterator[str]) -> None:
+        mismatches = [
+            (token, strptime_token(token), parse_date_token(token))
+            for token in tokens
+            if parse_date_token(token) != strptime_token(token)
+        ]
+        self.assertEqual(mismatches[:10], [])
+
+    def test_day_month_tokens(self) -> None:
+        self.assert_matches_strptime(iter_day_month_tokens())
+
+    def test_iso_tokens(self) -> None:
+        self.assert_matches_strptime(iter_iso_tokens())
+
+    def test_two_digit_year_pivot(self) -> None:
+        self.assertEqual(parse_date_token("01/02/68"), "2068-02-01")
+        self.assertEqual(parse_date_token("01/02/69"), "1969-02-01")
+        self.assertEqual(parse_date_token("29-02-00"), "2000-02-29")
+        self.assertIsNone(parse_date_token("29/02/23"))
+
+
+class DateTextEquivalenceTest(unittest.TestCase):
+    def test_generated_texts(self) -> None:
+        generator = random.Random(42)
+        tokens = list(iter_day_month_tokens())[::7] + list(iter_iso_tokens())
+        texts = [generator.choice(TEXT_CONTEXTS).format(generator.choice(tokens)) for _ in range(20000)]
+        mismatches = [
+            (text, strptime_text(text), parse_date_from_text(text))
+            for text in texts
+            if parse_date_from_text(text) != strptime_text(text)
+        ]
+        self.assertEqual(mismatches[:10], [])
+        self.assertEqual(parse_dates_from_texts(texts), [parse_date_from_text(text) for text in texts])
+
+    def test_only_first_match_counts(self) -> None:
+        self.assertIsNone(parse_date_from_text("31/02/2024 poi 01/03/2024"))
+        self.assertIsNone(parse_date_from_text("12/03-2024 e 12/03/2024"))
+        self.assertEqual(parse_date_from_text("ritiro 2024-03-12, 13/03/2024"), "2024-03-12")
+
+
+if __name__ == "__main__":
+    unittest.main()